@@ -1,4 +1,7 @@
-# this entire files structure should only be imported if you have angr installed in the same
-# environment as this package.
+# this entire files structure should only be used if you have angr installed in the same
+# environment as this package. angr and ailment are imported lazily, so things like ail_pickle_to_cfg
+# still work without them.
 #
-from .ail_graph_conv import binary_to_ail_cfgs, binary_to_generic_cfgs, ail_pickle_to_cfg, ail_cfg_to_generic
+from .ail_graph_conv import (
+    binary_to_ail_cfgs, binary_to_generic_cfgs, ail_pickle_to_cfg, ail_cfg_to_generic, clear_project_cache
+)
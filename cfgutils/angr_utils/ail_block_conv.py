@@ -1,5 +1,5 @@
-from collections import defaultdict
-from typing import Optional
+from collections import deque
+from typing import Optional, Dict, Deque
 
 from ailment import BinaryOp, UnaryOp, Assignment
 from ailment.block_walker import AILBlockWalkerBase
@@ -10,119 +10,152 @@ from ailment.expression import Const, Load, ITE, Convert
 from cfgutils.angr_utils.prettyify_ail import string_at_addr
 from cfgutils.data.generic_statement import GenericStatement
 
+_SENTINEL = object()
+
 
 class AILBlockConverter(AILBlockWalkerBase):
     def __init__(self, project=None, project_cfg=None):
-        self.stmt_by_idx = defaultdict(list)
+        # the generic statements made from each AIL statement, innermost expression first
+        self.stmt_by_idx: Dict[int, Deque[GenericStatement]] = {}
         self._project = project
         self._project_cfg = project_cfg
+        # strings can only be recovered with both a project and its CFG
+        self._resolve_strings = project is not None and project_cfg is not None
+        # const value -> fixed-up operand, since the same addresses show up across many statements
+        self._str_cache: Dict[int, object] = {}
         super().__init__()
 
     @property
     def statements(self):
-        ordered = []
-        for idx, stmts in self.stmt_by_idx.items():
-            ordered.append(reversed(stmts))
+        return list(self.stmt_by_idx.values())
 
-        return ordered
+    def _add_statement(self, stmt_idx: int, generic_stmt: GenericStatement):
+        stmts = self.stmt_by_idx.get(stmt_idx)
+        if stmts is None:
+            stmts = self.stmt_by_idx[stmt_idx] = deque()
+        stmts.appendleft(generic_stmt)
 
     def _fix_string_and_imms(self, const):
         if not isinstance(const, Const):
             return str(const)
+        if not self._resolve_strings:
+            return const.value
 
-        str_val = None
-        if self._project is not None and self._project_cfg is not None:
-            str_val = string_at_addr(self._project_cfg, const.value, self._project, max_size=200)
+        cached = self._str_cache.get(const.value, _SENTINEL)
+        if cached is not _SENTINEL:
+            return cached
 
-        return str_val if str_val is not None else const.value
+        str_val = string_at_addr(self._project_cfg, const.value, self._project, max_size=200)
+        fixed = str_val if str_val is not None else const.value
+        # float values compare equal to ints (1.0 == 1), so only int values are cached
+        if type(const.value) is int:
+            self._str_cache[const.value] = fixed
+        return fixed
 
     def _fix_list(self, _list):
         if not _list:
-            return []
-
-        out = []
-        for _l in _list:
-            out.append(self._fix_string_and_imms(_l))
-
-        return out
+            return ()
+
+        fix = self._fix_string_and_imms
+        return tuple(fix(_l) for _l in _list)
+
+    def walk(self, block: Block):
+        # the converter never edits the block, so statements are dispatched in one plain loop rather than through
+        # the base walker's re-checked index loop and _handle_stmt
+        stmt_handlers = self.stmt_handlers
+        for stmt_idx, stmt in enumerate(block.statements):
+            handler = stmt_handlers.get(type(stmt), None)
+            if handler is not None:
+                handler(stmt_idx, stmt, block)
+
+    def _walk_exprs(self, exprs, stmt_idx: int, stmt: Statement, block: Optional[Block]):
+        """
+        Dispatches each child expression straight to its handler, which is what the base walker's handlers do
+        through _handle_expr.
+        """
+        expr_handlers = self.expr_handlers
+        for expr_idx, expr in enumerate(exprs):
+            handler = expr_handlers.get(type(expr), None)
+            if handler is not None:
+                handler(expr_idx, expr, stmt_idx, stmt, block)
 
     #
     # Statements
     #
 
     def _handle_Call(self, stmt_idx: int, stmt: "Call", block: Optional["Block"]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], "call", self._fix_list(stmt.args))
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], "call", self._fix_list(stmt.args))
         )
-        return super()._handle_Call(stmt_idx, stmt, block)
+        self._walk_exprs(stmt.args or (), stmt_idx, stmt, block)
 
     def _handle_Return(self, stmt_idx: int, stmt: Return, block: Optional[Block]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], "ret", self._fix_list(stmt.ret_exprs))
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], "ret", self._fix_list(stmt.ret_exprs))
         )
-        return super()._handle_Return(stmt_idx, stmt, block)
+        self._walk_exprs(stmt.ret_exprs or (), stmt_idx, stmt, block)
 
     def _handle_Store(self, stmt_idx: int, stmt: Store, block: Optional[Block]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], "store", [
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], "store", (
                 self._fix_string_and_imms(stmt.addr), self._fix_string_and_imms(stmt.data)
-            ])
+            ))
         )
-        return super()._handle_Store(stmt_idx, stmt, block)
+        self._walk_exprs((stmt.addr, stmt.data), stmt_idx, stmt, block)
 
     def _handle_Assignment(self, stmt_idx: int, stmt: Assignment, block: Optional[Block]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], "assign", [
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], "assign", (
                 self._fix_string_and_imms(stmt.dst), self._fix_string_and_imms(stmt.src)
-            ])
+            ))
         )
-        return super()._handle_Assignment(stmt_idx, stmt, block)
+        self._walk_exprs((stmt.dst, stmt.src), stmt_idx, stmt, block)
 
     def _handle_ConditionalJump(self, stmt_idx: int, stmt: ConditionalJump, block: Optional[Block]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], "cond_jmp", [
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], "cond_jmp", (
                 self._fix_string_and_imms(stmt.condition), self._fix_string_and_imms(stmt.true_target),
                 self._fix_string_and_imms(stmt.false_target)
-            ])
+            ))
         )
-        return super()._handle_ConditionalJump(stmt_idx, stmt, block)
+        self._walk_exprs((stmt.condition, stmt.true_target, stmt.false_target), stmt_idx, stmt, block)
 
     #
     # Expr
     #
 
     def _handle_Load(self, expr_idx: int, expr: Load, stmt_idx: int, stmt: Statement, block: Optional[Block]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], "load", [
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], "load", (
                 self._fix_string_and_imms(expr.addr), self._fix_string_and_imms(expr.size)
-            ])
+            ))
         )
-        return super()._handle_Load(expr_idx, expr, stmt_idx, stmt, block)
+        self._walk_exprs((expr.addr,), stmt_idx, stmt, block)
 
     def _handle_ITE(self, expr_idx: int, expr: ITE, stmt_idx: int, stmt: Statement, block: Optional[Block]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], "ITE", [
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], "ITE", (
                 self._fix_string_and_imms(expr.cond), self._fix_string_and_imms(expr.iftrue),
                 self._fix_string_and_imms(expr.iffalse)
-            ])
+            ))
         )
-        return super()._handle_ITE(expr_idx, expr, stmt_idx, stmt, block)
+        self._walk_exprs((expr.cond, expr.iftrue, expr.iffalse), stmt_idx, stmt, block)
 
     def _handle_BinaryOp(self, expr_idx: int, expr: BinaryOp, stmt_idx: int, stmt: Statement, block: Optional[Block]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], expr.op, self._fix_list(expr.operands))
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], expr.op, self._fix_list(expr.operands))
         )
-        return super()._handle_BinaryOp(expr_idx, expr, stmt_idx, stmt, block)
+        self._walk_exprs(expr.operands, stmt_idx, stmt, block)
 
     def _handle_UnaryOp(self, expr_idx: int, expr: UnaryOp, stmt_idx: int, stmt: Statement, block: Optional[Block]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], expr.op, self._fix_string_and_imms(expr.operand))
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], expr.op, self._fix_string_and_imms(expr.operand))
         )
-        return super()._handle_UnaryOp(expr_idx, expr, stmt_idx, stmt, block)
+        self._walk_exprs((expr.operand,), stmt_idx, stmt, block)
 
     def _handle_CallExpr(self, expr_idx: int, expr: "Call", stmt_idx: int, stmt, block: Optional["Block"]):
-        self.stmt_by_idx[stmt_idx].append(
-            GenericStatement(stmt.tags['ins_addr'], "call", self._fix_list(expr.args))
+        self._add_statement(
+            stmt_idx, GenericStatement(stmt.tags['ins_addr'], "call", self._fix_list(expr.args))
         )
-        return super()._handle_CallExpr(expr_idx, expr, stmt_idx, stmt, block)
+        self._walk_exprs(expr.args or (), stmt_idx, stmt, block)
 
@@ -1,22 +1,43 @@
+# angr and ailment are only imported by the functions that need them, so that the rest of this module (like
+# ail_pickle_to_cfg) can be used without paying for, or even having, them
+from __future__ import annotations
+
+import functools
+import heapq
+import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import logging
-from typing import Union, Dict, Tuple
+from collections import OrderedDict
+from typing import Union, Dict, Tuple, Optional, TYPE_CHECKING
 
-import ailment
 import networkx as nx
-import angr
-from angr.analyses.decompiler.optimization_passes import DUPLICATING_OPTS, CONDENSING_OPTS
 
-from .prettyify_ail import stmt_to_pretty_text
 from cfgutils.data.generic_block import GenericBlock
+from cfgutils.data.csr_graph import CSRGraph
+
+if TYPE_CHECKING:
+    import ailment
+    import angr
 
 _l = logging.getLogger(__name__)
 
+# (binary path, mtime, function starts, targeted) -> (angr.Project, CFG), shared across calls in this process. it is
+# ordered from least to most recently used, and only holds the last _PROJECT_CACHE_SIZE, since each one is large
+_PROJECT_CACHE: OrderedDict[tuple, tuple] = OrderedDict()
+_PROJECT_CACHE_SIZE = 4
+# with targeted_cfg, only the code of the requested functions is recovered when fewer addresses than this are given
+_TARGETED_CFG_MAX_FUNCS = 32
+# the assumed size of a requested function that has no sized symbol
+_DEFAULT_FUNC_REGION_SIZE = 0x2000
+# the angr Project each decompilation worker process unpickles once, at startup
+_WORKER_PROJECT = None
+
 
 def binary_to_ail_cfgs(
     binary_path: Path, functions=None, make_generic=False, structuring_opts=True, supergraph=True,
-    return_project=False,
+    return_project=False, use_cache=True, compact=False, max_workers: Optional[int] = 1, targeted_cfg=False,
 ) -> Union[Dict[str, nx.DiGraph], Tuple[Dict[str, nx.DiGraph], angr.Project]]:
     """
     A simple wrapper around the angr decompiler to simply use the defaults and return the AIL CFGs which
@@ -30,37 +51,25 @@ def binary_to_ail_cfgs(
     :param structuring_opts: Enable or disable structuring optimizations
     :param supergraph: Convert the AIL CFGs to supergraphs
     :param return_project: Return the angr Project object as well
+    :param use_cache: Reuse the Project and CFG from an earlier call on the same (unmodified) binary
+    :param compact: When used with make_generic, return CSRGraph CFGs instead of networkx.DiGraph CFGs
+    :param max_workers: Number of processes to decompile functions in. If None, one per CPU is used
+    :param targeted_cfg: When functions is a short list of addresses, only recover the CFG of those functions
+                         (and skip calling convention analysis of the rest of the binary). This is much faster on
+                         large binaries, but callee prototypes are no longer recovered, so the AIL of a function
+                         can differ from the one decompiled with the full CFG (e.g. in casts and variable numbering).
     """
     binary_path = Path(binary_path).absolute()
     if not binary_path.exists():
         raise FileNotFoundError(f"{binary_path} does not exist")
 
-    proj = angr.Project(binary_path, auto_load_libs=False)
     func_starts = None
     if functions is not None and all(isinstance(func, int) for func in functions):
         func_starts = functions
 
-    cfg = proj.analyses.CFG(
-        show_progressbar=False, normalize=True, data_references=True, resolve_indirect_jumps=True,
-        function_starts=func_starts
+    proj, cfg = _get_project_and_cfg(
+        binary_path, func_starts=func_starts, use_cache=use_cache, targeted_cfg=targeted_cfg
     )
-    try:
-        proj.analyses.CompleteCallingConventions(cfg=cfg, recover_variables=True, analyze_callsites=True)
-        cc_failed = False
-    except Exception:
-        cc_failed = True
-
-    if cc_failed:
-        _l.warning(f"CallingConvention Analysis failed on {binary_path}. Trying again without variable recovery...")
-        try:
-            # try it again without variable recovery
-            proj.analyses.CompleteCallingConventions(cfg=cfg, recover_variables=False)
-            cc_failed = False
-        except Exception:
-            pass
-
-    if cc_failed:
-        _l.critical(f"All attempts to run CallingConvention Analysis failed on {binary_path}.")
 
     # clean up function names
     functions = functions or cfg.functions
@@ -68,16 +77,11 @@ def binary_to_ail_cfgs(
         if "." in func.name:
             func.name = func.name[:func.name.index(".")]
 
-    # some optimizations can drastically change the structure of the CFG, so we should disable some if wanted
-    all_optimizations = angr.analyses.decompiler.optimization_passes.get_optimization_passes(
-        proj.arch, "linux"
-    )
-    if not structuring_opts:
-        all_optimizations = [opt for opt in all_optimizations if opt not in DUPLICATING_OPTS + CONDENSING_OPTS]
+    all_optimizations = list(_get_optimization_passes(proj.arch.name, structuring_opts))
 
     # generate a cfg for each function
-    ail_cfgs = {}
-    for func_idx, func_addr in enumerate(functions):
+    targets = []
+    for func_addr in functions:
         try:
             f = cfg.functions[func_addr]
         except Exception:
@@ -87,14 +91,20 @@ def binary_to_ail_cfgs(
         if f is None or f.is_plt:
             continue
 
-        # for this function you don't actually need the linear decompilation, but we run through the entire
-        # decompilation process to assure every optimization is run that would be done on a normal Clinic graph
-        dec = proj.analyses.Decompiler(f, cfg=cfg, kb=cfg.kb, optimization_passes=all_optimizations, generate_code=False)
-        dec.ail_graph.name = str(f.name)
-        ail_cfgs[str(f.name)] = dec.ail_graph if not supergraph else to_ail_supergraph(dec.ail_graph)
+        targets.append(f)
+
+    if max_workers == 1 or len(targets) <= 1:
+        decompiled = [
+            _decompile_function(proj, cfg, cfg.kb, f, all_optimizations, supergraph) for f in targets
+        ]
+    else:
+        decompiled = _decompile_functions_in_pool(
+            proj, [f.addr for f in targets], all_optimizations, supergraph, max_workers
+        )
+    ail_cfgs = dict(decompiled)
 
     if make_generic:
-        cfgs = [ail_cfg_to_generic(cfg, proj) for name, cfg in ail_cfgs.items()]
+        cfgs = [ail_cfg_to_generic(cfg, proj, compact=compact) for name, cfg in ail_cfgs.items()]
     else:
         cfgs = list(ail_cfgs.values())
 
@@ -105,29 +115,188 @@ def binary_to_ail_cfgs(
         return named_cfgs
 
 
-def ail_cfg_to_generic(cfg: nx.DiGraph, project=None):
-    new_cfg = nx.DiGraph()
-    new_cfg.name = cfg.name
+@functools.lru_cache(maxsize=None)
+def _get_optimization_passes(arch_name: str, structuring_opts: bool) -> tuple:
+    from angr.analyses.decompiler.optimization_passes import (
+        get_optimization_passes, DUPLICATING_OPTS, CONDENSING_OPTS
+    )
+
+    all_optimizations = get_optimization_passes(arch_name, "linux")
+    # some optimizations can drastically change the structure of the CFG, so we should disable some if wanted
+    if not structuring_opts:
+        structure_changing_opts = frozenset(DUPLICATING_OPTS + CONDENSING_OPTS)
+        all_optimizations = [opt for opt in all_optimizations if opt not in structure_changing_opts]
+
+    return tuple(all_optimizations)
+
+
+def _decompile_function(proj, cfg, kb, f, optimizations, supergraph) -> Tuple[str, nx.DiGraph]:
+    # for this function you don't actually need the linear decompilation, but we run through the entire
+    # decompilation process to assure every optimization is run that would be done on a normal Clinic graph
+    dec = proj.analyses.Decompiler(f, cfg=cfg, kb=kb, optimization_passes=optimizations, generate_code=False)
+    dec.ail_graph.name = str(f.name)
+    return str(f.name), dec.ail_graph if not supergraph else to_ail_supergraph(dec.ail_graph, copy_on_merge=False)
+
+
+def _decompile_functions_in_pool(proj, func_addrs, optimizations, supergraph, max_workers=None):
+    """
+    Decompiles each function in a separate process. The Project is pickled once and unpickled once per
+    worker, and each AIL graph is pickled back to this process.
+    """
+    proj_bytes = pickle.dumps(proj, protocol=5)
+    max_workers = min(max_workers or os.cpu_count() or 1, len(func_addrs))
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_decompile_worker, initargs=(proj_bytes,)
+    ) as executor:
+        results = executor.map(
+            _decompile_in_worker, func_addrs, [optimizations] * len(func_addrs), [supergraph] * len(func_addrs)
+        )
+        return [pickle.loads(result) for result in results]
+
+
+def _init_decompile_worker(proj_bytes: bytes):
+    global _WORKER_PROJECT
+    _WORKER_PROJECT = pickle.loads(proj_bytes)
+
+
+def _decompile_in_worker(func_addr, optimizations, supergraph) -> bytes:
+    proj = _WORKER_PROJECT
+    f = proj.kb.functions[func_addr]
+    decompiled = _decompile_function(proj, proj.kb.cfgs.get_most_accurate(), proj.kb, f, optimizations, supergraph)
+    return pickle.dumps(decompiled, protocol=5)
+
+
+def _get_project_and_cfg(binary_path: Path, func_starts=None, use_cache=True, targeted_cfg=False):
+    """
+    Loads the binary into an angr Project and recovers its CFG and calling conventions. The results are
+    cached on the resolved path, modification time, and requested function starts of the binary, so repeated
+    calls on the same binary skip the full reanalysis. Only the most recently used few are kept.
+    """
+    binary_path = Path(binary_path).resolve()
+    targeted = targeted_cfg and func_starts is not None and len(func_starts) < _TARGETED_CFG_MAX_FUNCS
+    cache_key = (
+        str(binary_path), binary_path.stat().st_mtime_ns, tuple(func_starts) if func_starts is not None else None,
+        targeted,
+    )
+    if use_cache and cache_key in _PROJECT_CACHE:
+        _PROJECT_CACHE.move_to_end(cache_key)
+        return _PROJECT_CACHE[cache_key]
+
+    import angr
+
+    proj = angr.Project(binary_path, auto_load_libs=False)
+    cfg_kwargs = {}
+    cc_kwargs = {}
+    if targeted:
+        # a handful of functions was requested, so skip recovering (and analyzing) the rest of the binary
+        cfg_kwargs = {"regions": _function_regions(proj, func_starts), "force_complete_scan": False, "symbols": False}
+        cc_kwargs = {"prioritize_func_addrs": func_starts, "skip_other_funcs": True}
+
+    cfg = proj.analyses.CFG(
+        show_progressbar=False, normalize=True, data_references=True, resolve_indirect_jumps=True,
+        function_starts=func_starts, **cfg_kwargs
+    )
+    try:
+        proj.analyses.CompleteCallingConventions(
+            cfg=cfg, recover_variables=True, analyze_callsites=True, **cc_kwargs
+        )
+        cc_failed = False
+    except Exception:
+        cc_failed = True
+
+    if cc_failed:
+        _l.warning(f"CallingConvention Analysis failed on {binary_path}. Trying again without variable recovery...")
+        try:
+            # try it again without variable recovery
+            proj.analyses.CompleteCallingConventions(cfg=cfg, recover_variables=False, **cc_kwargs)
+            cc_failed = False
+        except Exception:
+            pass
+
+    if cc_failed:
+        _l.critical(f"All attempts to run CallingConvention Analysis failed on {binary_path}.")
+
+    if use_cache:
+        # entries for an older version of the binary can never be used again
+        for key in [key for key in _PROJECT_CACHE if key[0] == cache_key[0] and key[1] != cache_key[1]]:
+            del _PROJECT_CACHE[key]
+        _PROJECT_CACHE[cache_key] = (proj, cfg)
+        while len(_PROJECT_CACHE) > _PROJECT_CACHE_SIZE:
+            _PROJECT_CACHE.popitem(last=False)
+
+    return proj, cfg
+
+
+def _function_regions(proj, func_starts):
+    """
+    Computes the (start, end) address range of each requested function, using the size of its symbol when
+    one is available.
+    """
+    regions = []
+    for func_start in func_starts:
+        symbol = proj.loader.find_symbol(func_start)
+        size = symbol.size if symbol is not None and symbol.size else _DEFAULT_FUNC_REGION_SIZE
+        regions.append((func_start, func_start + size))
+
+    return regions
+
+
+def clear_project_cache():
+    """
+    Drops all angr Projects and CFGs cached by binary_to_ail_cfgs.
+    """
+    _PROJECT_CACHE.clear()
+
+
+def ail_cfg_to_generic(cfg: nx.DiGraph, project=None, compact=False) -> Union[nx.DiGraph, CSRGraph]:
+    """
+    Converts an AIL CFG into a GenericBlock CFG.
+
+    :param cfg: The AIL CFG to convert
+    :param project: The angr Project the CFG came from, used to pretty-print statements
+    :param compact: Return a CSRGraph instead of a networkx.DiGraph. Node attributes are not kept.
+    """
+    from .prettyify_ail import stmt_to_pretty_text
+
     proj_cfg = project.kb.cfgs.get_most_accurate() if project is not None else None
     node_map = {}
-    for node, attr in cfg.nodes(data=True):
-        new_node = GenericBlock(node.addr, idx=node.idx if hasattr(node, "idx") else None)
+    # whether a node has an idx only depends on its type, so only check once per type
+    has_idx_by_type = {}
+    # the graph keeps every AIL expression alive, so rendered expressions can be shared across all statements
+    render_cache = {}
+    for node in cfg.nodes:
+        node_type = type(node)
+        has_idx = has_idx_by_type.get(node_type, None)
+        if has_idx is None:
+            has_idx = has_idx_by_type[node_type] = hasattr(node, "idx")
+
+        new_node = GenericBlock(node.addr, idx=node.idx if has_idx else None)
         for stmt in node.statements:
-            str_stmt = stmt_to_pretty_text(stmt, project, proj_cfg) if project is not None else str(stmt)
+            str_stmt = (
+                stmt_to_pretty_text(stmt, project, proj_cfg, render_cache=render_cache)
+                if project is not None else str(stmt)
+            )
             new_node.statements.append(str_stmt)
-
-        attr = attr or {}
-        new_attr = attr.copy()
-        if "node" in new_attr:
-            del new_attr["node"]
-
-        new_cfg.add_node(new_node, node=new_node, **new_attr)
         node_map[node] = new_node
 
-    for src, dst in cfg.edges:
-        new_src = node_map[src]
-        new_dst = node_map[dst]
-        new_cfg.add_edge(new_src, new_dst, src=new_src, dst=new_dst)
+    if compact:
+        return CSRGraph.from_networkx(cfg, node_map=node_map)
+
+    new_cfg = nx.DiGraph()
+    new_cfg.name = cfg.name
+    new_nodes = []
+    for node, attr in cfg.nodes(data=True):
+        new_node = node_map[node]
+        new_attr = {"node": new_node}
+        if attr:
+            new_attr.update((k, v) for k, v in attr.items() if k != "node")
+        new_nodes.append((new_node, new_attr))
+    new_cfg.add_nodes_from(new_nodes)
+
+    # the src and dst edge attributes are used by the graph edit distance code
+    new_cfg.add_edges_from(
+        (node_map[src], node_map[dst], {"src": node_map[src], "dst": node_map[dst]}) for src, dst in cfg.edges
+    )
 
     return new_cfg
 
@@ -147,17 +316,18 @@ def ail_pickle_to_cfg(pickle_path: Path):
     with open(pickle_path, "rb") as fp:
         ail_str_cfg: nx.DiGraph = pickle.load(fp)
 
-    new_cfg = nx.DiGraph()
-    node_map = {}
-    for node in ail_str_cfg.nodes:
-        new_node = GenericBlock(int(node), statements=ail_str_cfg.nodes[node]["label"])
-        new_cfg.add_node(new_node, node=new_node)
-        node_map[node] = new_node
+    node_map = {
+        node: GenericBlock(int(node), statements=label) for node, label in ail_str_cfg.nodes(data="label")
+    }
+    edges = list(ail_str_cfg.edges)
+    # the string graph is no longer needed, so don't keep it alive next to the new graph
+    del ail_str_cfg
 
-    for src, dst in ail_str_cfg.edges:
-        new_src = node_map[src]
-        new_dst = node_map[dst]
-        new_cfg.add_edge(new_src, new_dst, src=new_src, dst=new_dst)
+    new_cfg = nx.DiGraph()
+    new_cfg.add_nodes_from((new_node, {"node": new_node}) for new_node in node_map.values())
+    new_cfg.add_edges_from(
+        (node_map[src], node_map[dst], {"src": node_map[src], "dst": node_map[dst]}) for src, dst in edges
+    )
 
     return new_cfg
 
@@ -167,66 +337,141 @@ def ail_pickle_to_cfg(pickle_path: Path):
 #   this code was added as a hotfix to make the AIL CFGs supergraphs
 #
 
-def _merge_ail_nodes(graph, node_a: ailment.Block, node_b: ailment.Block) -> ailment.Block:
-    in_edges = list(graph.in_edges(node_a, data=True))
-    out_edges = list(graph.out_edges(node_b, data=True))
+def _merge_ail_nodes(node_a: ailment.Block, node_b: ailment.Block, in_place=False) -> ailment.Block:
+    """
+    Merges node_b, the only successor of node_a, with node_a. The merged node is whichever node has the lower
+    address (or a copy of it, unless in_place is set), followed by the statements of the other node.
+    """
+    from ailment.statement import Jump
+
+    new_node, old_node = (node_a, node_b) if node_a.addr <= node_b.addr else (node_b, node_a)
+    if not in_place:
+        new_node = new_node.copy()
 
-    a_ogs = graph.nodes[node_a].get("original_nodes", set())
-    b_ogs = graph.nodes[node_b].get("original_nodes", set())
-    new_node = node_a.copy() if node_a.addr <= node_b.addr else node_b.copy()
-    old_node = node_b if new_node == node_a else node_a
     # remove jumps in the middle of nodes when merging
-    if new_node.statements and isinstance(new_node.statements[-1], ailment.Stmt.Jump):
-        new_node.statements = new_node.statements[:-1]
-    new_node.statements += old_node.statements
+    if new_node.statements and isinstance(new_node.statements[-1], Jump):
+        del new_node.statements[-1]
+    new_node.statements.extend(old_node.statements)
     new_node.original_size += old_node.original_size
 
-    graph.remove_node(node_a)
-    graph.remove_node(node_b)
-
-    if new_node is not None:
-        graph.add_node(new_node, original_nodes=a_ogs.union(b_ogs))
-        for src, _, data in in_edges:
-            if src is node_b:
-                src = new_node
-            graph.add_edge(src, new_node, **data)
-
-        for _, dst, data in out_edges:
-            if dst is node_a:
-                dst = new_node
-            graph.add_edge(new_node, dst, **data)
-
     return new_node
 
 
-def to_ail_supergraph(transition_graph: nx.DiGraph) -> nx.DiGraph:
+def to_ail_supergraph(transition_graph: nx.DiGraph, copy_on_merge=True) -> nx.DiGraph:
     """
     Takes an AIL graph and converts it into a AIL graph that treats calls and redundant jumps
     as parts of a bigger block instead of transitions. Calls to returning functions do not terminate basic blocks.
 
     Based on region_identifier super_graph
 
+    :param transition_graph: The AIL graph to convert
+    :param copy_on_merge: Copy blocks before merging others into them. When disabled, the blocks of the input
+                          graph may be modified.
     :return: A converted super transition graph
     """
-    # make a copy of the graph
-    transition_graph = nx.DiGraph(transition_graph)
-    nx.set_node_attributes(transition_graph, {node: {node} for node in transition_graph.nodes}, "original_nodes")
-
-    while True:
-        for src, dst, data in transition_graph.edges(data=True):
-            type_ = data.get("type", None)
-
-            if len(list(transition_graph.successors(src))) == 1 and len(list(transition_graph.predecessors(dst))) == 1:
-                # calls in the middle of blocks OR boring jumps
-                # XXX: patch is here
-                _merge_ail_nodes(transition_graph, src, dst)
-                break
+    # the graph is rewritten on ids rather than on the blocks: networkx may key an edge on a block that only compares
+    # equal to the node object, and blocks merged into in place would change their hashes
+    blocks = list(transition_graph.nodes)
+    ids = {block: i for i, block in enumerate(blocks)}
+    graph = nx.DiGraph()
+    graph.add_nodes_from(range(len(blocks)))
+    graph.add_edges_from((ids[src], ids[dst], data) for src, dst, data in transition_graph.edges(data=True))
+    blocks = dict(enumerate(blocks))
+    original_nodes = {i: {block} for i, block in blocks.items()}
+
+    # every step acts on the first edge, in edge order, that is either mergeable or a call. merged nodes are added to
+    # the back of the graph and ids only grow, so that edge is always out of the smallest id with such an edge. ids
+    # are kept in a heap and only the neighbors of the nodes that changed are checked again after each step.
+    heap = list(graph.nodes)
+    next_node = len(blocks)
+    while heap:
+        src = heapq.heappop(heap)
+        if src not in graph:
+            continue
+        action = _supergraph_action(graph, src)
+        if action is None:
+            continue
 
+        merge, dst = action
+        if merge:
+            # calls in the middle of blocks OR boring jumps
+            winner = src if blocks[src].addr <= blocks[dst].addr else dst
+            # blocks made by an earlier merge are never part of the input graph, so they can always be merged into
+            new_block = _merge_ail_nodes(
+                blocks[src], blocks[dst], in_place=not copy_on_merge or len(original_nodes[winner]) > 1
+            )
+            new_node = next_node
+            next_node += 1
+            _merge_supergraph_nodes(graph, src, dst, new_node)
+            blocks[new_node] = new_block
+            original_nodes[new_node] = original_nodes.pop(src) | original_nodes.pop(dst)
+            del blocks[src], blocks[dst]
+            # the predecessors now have their edge to the merged node last
+            changed = [new_node, *graph.pred[new_node]]
+        else:
             # calls to functions with no return
-            elif type_ == "call":
-                transition_graph.remove_node(dst)
-                break
+            changed = list(graph.pred[dst])
+            for succ in graph.succ[dst]:
+                changed += graph.pred[succ]
+            graph.remove_node(dst)
+            del blocks[dst], original_nodes[dst]
+
+        for node in changed:
+            if node in graph:
+                heapq.heappush(heap, node)
+
+    supergraph = nx.DiGraph()
+    supergraph.graph.update(transition_graph.graph)
+    for node in graph:
+        block = blocks[node]
+        ogs = original_nodes[node]
+        if len(ogs) == 1:
+            supergraph.add_node(block, **transition_graph.nodes[block])
+            supergraph.nodes[block]["original_nodes"] = ogs
         else:
-            break
+            supergraph.add_node(block, original_nodes=ogs)
+
+    for src, dst, data in graph.edges(data=True):
+        supergraph.add_edge(blocks[src], blocks[dst], **data)
+
+    return supergraph
+
+
+def _supergraph_action(graph: nx.DiGraph, src):
+    """
+    The first thing to_ail_supergraph does with the out-edges of src, in their order: (True, dst) to merge its only
+    edge, (False, dst) to remove the target of a call that does not return, or None if there is nothing to do.
+    """
+    succs = graph.succ[src]
+    if len(succs) == 1:
+        dst, data = next(iter(succs.items()))
+        if len(graph.pred[dst]) == 1:
+            # a node in a loop by itself is never merged with itself
+            return None if dst == src else (True, dst)
+        return (False, dst) if data.get("type", None) == "call" else None
+
+    for dst, data in succs.items():
+        if data.get("type", None) == "call":
+            return False, dst
+    return None
+
+
+def _merge_supergraph_nodes(graph: nx.DiGraph, node_a: int, node_b: int, new_node: int) -> None:
+    """
+    Replaces node_a and node_b, its only successor, with new_node at the back of the graph, which takes the in-edges
+    of node_a and the out-edges of node_b.
+    """
+    in_edges = list(graph.in_edges(node_a, data=True))
+    out_edges = list(graph.out_edges(node_b, data=True))
+    graph.remove_node(node_a)
+    graph.remove_node(node_b)
 
-    return transition_graph
\ No newline at end of file
+    graph.add_node(new_node)
+    for src, _, data in in_edges:
+        if src == node_b:
+            src = new_node
+        graph.add_edge(src, new_node, **data)
+    for _, dst, data in out_edges:
+        if dst == node_a:
+            dst = new_node
+        graph.add_edge(new_node, dst, **data)
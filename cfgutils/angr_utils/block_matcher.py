@@ -1,13 +1,75 @@
+from __future__ import annotations
+
 from collections import defaultdict
-from typing import List
+from dataclasses import dataclass
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional, Tuple, TYPE_CHECKING
 
-import networkx as nx
-from ailment import Block
-from ailment.statement import Call
+import numpy as np
 
-from cfgutils.sorting import quasi_topological_sort_nodes
 from cfgutils.similarity.block_matcher_base import BlockMatcherBase
-from .feat_extractor import AILBlockFeatureExtractor
+
+if TYPE_CHECKING:
+    from ailment import Block
+    import networkx as nx
+
+# below this many blocks per worker, starting the pool costs more than it saves
+_MIN_NODES_PER_WORKER = 32
+_WORKER_EXTRACTORS = []
+
+
+@dataclass
+class FeatCache:
+    """
+    The features of every block in a graph, stored as one column per feature. A block's features are found at
+    the row given by node_index[block]. The scalar count features share one matrix, with a column per count in
+    the order of COUNT_FEATURES, so they can be compared for many blocks at once.
+    """
+    COUNT_FEATURES = ("no_arith", "no_calls", "no_ins", "no_logic", "no_branch")
+
+    node_index: Dict[Block, int]
+    counts: np.ndarray
+    str_consts: np.ndarray
+    num_consts: np.ndarray
+    var_names: np.ndarray
+    stack_addrs: np.ndarray
+    func_names: np.ndarray
+    # the hashed sets the list features are scored by, built once per block
+    str_const_sets: np.ndarray
+    num_const_sets: np.ndarray
+    # the called names as a multiset: sorted, so order is ignored but repeated calls are not
+    func_name_keys: np.ndarray
+
+    @classmethod
+    def empty(cls, nodes) -> "FeatCache":
+        size = len(nodes)
+        return cls(
+            {node: i for i, node in enumerate(nodes)},
+            np.empty((size, len(cls.COUNT_FEATURES)), dtype=np.int32),
+            *(np.empty(size, dtype=object) for _ in range(8)),
+        )
+
+    @property
+    def no_arith(self) -> np.ndarray:
+        return self.counts[:, 0]
+
+    @property
+    def no_calls(self) -> np.ndarray:
+        return self.counts[:, 1]
+
+    @property
+    def no_ins(self) -> np.ndarray:
+        return self.counts[:, 2]
+
+    @property
+    def no_logic(self) -> np.ndarray:
+        return self.counts[:, 3]
+
+    @property
+    def no_branch(self) -> np.ndarray:
+        return self.counts[:, 4]
 
 
 class AILBlockMatcher(BlockMatcherBase):
@@ -30,6 +92,7 @@ class AILBlockMatcher(BlockMatcherBase):
         root_dist_tie_breaker=True,
         match_exact_calls=True,
         assume_rooted=True,
+        max_workers: Optional[int] = 1,
     ):
         super().__init__(
             g1,
@@ -45,10 +108,15 @@ class AILBlockMatcher(BlockMatcherBase):
         self._use_var_names = use_var_names
         self._use_caller_names = use_caller_names
         self._caller_name_mapping = caller_name_mapping or {}
+        self._max_workers = max_workers
 
-        self._g1_cache = defaultdict(dict)
-        self._g2_cache = defaultdict(dict)
+        self._g1_cache = FeatCache.empty(self._g1_nodes)
+        self._g2_cache = FeatCache.empty(self._g2_nodes)
+        # graphs are looked up by identity. g1 is added last, so it wins if both graphs are the same object
+        self._caches_by_graph_id = {id(g2): self._g2_cache, id(g1): self._g1_cache}
         self.generate_feat_cache()
+        self._in_degrees = {g: dict(g.in_degree()) for g in (self._g1, self._g2)}
+        self._out_degrees = {g: dict(g.out_degree()) for g in (self._g1, self._g2)}
 
         if match_exact_calls:
             self.mapping = self.match_exact_calls()
@@ -62,16 +130,22 @@ class AILBlockMatcher(BlockMatcherBase):
         :return:
         """
         mapping = {}
+        c1, c2 = self._g1_cache, self._g2_cache
+        in_deg1, out_deg1 = self._in_degrees[self._g1], self._out_degrees[self._g1]
+        in_deg2, out_deg2 = self._in_degrees[self._g2], self._out_degrees[self._g2]
+        # index g2 once by (call count, called names) so each b1 only looks at blocks calling the same things. the
+        # names are a sorted tuple, so blocks only match when they call each name the same number of times
+        call_buckets = defaultdict(list)
+        for b2 in self._g2.nodes:
+            b2_idx = c2.node_index[b2]
+            if c2.no_calls[b2_idx] != 0:
+                call_buckets[(c2.no_calls[b2_idx], c2.func_name_keys[b2_idx])].append(b2)
+
         for b1 in self._g1.nodes:
-            choices = []
-            # search all cases of names and amount lining up
-            for b2 in self._g2.nodes:
-                if (
-                    self.get_number_of_calls(b1, self._g1) == self.get_number_of_calls(b2, self._g2) != 0 and
-                    # XXX: this could be bad, order should matter...
-                    set(self._g1_cache[b1][self.TYP_FUNC_NAMES]) == set(self._g2_cache[b2][self.TYP_FUNC_NAMES])
-                ):
-                    choices.append(b2)
+            b1_idx = c1.node_index[b1]
+            if c1.no_calls[b1_idx] == 0:
+                continue
+            choices = call_buckets.get((c1.no_calls[b1_idx], c1.func_name_keys[b1_idx]), [])
 
             # since there can be multiple blocks that meet the above criteria, if we have to choose,
             # then we must be sure its the same. To do that, we use their distance from the root.
@@ -79,10 +153,10 @@ class AILBlockMatcher(BlockMatcherBase):
                 mapping[b1] = choices[0]
             else:
                 # first attempt to eliminate all choices with different edge amounts
+                b1_in_deg, b1_out_deg = in_deg1[b1], out_deg1[b1]
                 same_edge_choices = [
                     choice for choice in choices
-                    if len(list(self._g2.predecessors(choice))) == len(list(self._g1.predecessors(b1))) and
-                    len(list(self._g2.successors(choice))) == len(list(self._g1.successors(b1)))
+                    if in_deg2[choice] == b1_in_deg and out_deg2[choice] == b1_out_deg
                 ]
                 if len(same_edge_choices) == 1:
                     mapping[b1] = same_edge_choices[0]
@@ -97,60 +171,243 @@ class AILBlockMatcher(BlockMatcherBase):
         return mapping
 
     def generate_feat_cache(self):
-        for g, proj, features in [(self._g1, self._proj1, self._g1_cache), (self._g2, self._proj2, self._g2_cache)]:
-            proj_cfg = proj.kb.cfgs.get_most_accurate() if proj is not None else None
-            for node in g.nodes:
-                feat_extractor = AILBlockFeatureExtractor(proj, proj_cfg, call_name_fallback=self._caller_name_mapping)
-                feat_extractor.walk(node)
-                features[node][self.TYP_NO_ARITHMETIC_INS] = len(feat_extractor.arith_ins)
-                features[node][self.TYP_NO_CALLS] = len(feat_extractor.calls)
-                features[node][self.TYP_NO_INS] = len(feat_extractor.ins)
-                features[node][self.TYP_NO_LOGIC_INS] = len(feat_extractor.logic_ins)
-                features[node][self.TYP_NO_BRANCH_INS] = len(feat_extractor.branch_ins)
-                features[node][self.TYP_STR_CONST] = feat_extractor.str_consts
-                features[node][self.TYP_NUM_CONST] = feat_extractor.num_consts
-                features[node][self.TYP_VAR_NAMES] = feat_extractor.var_names
-                features[node][self.TYP_STACK_ADDRS] = feat_extractor.stack_addrs
-                features[node][self.TYP_FUNC_NAMES] = feat_extractor.call_names
-
-    def _get_correct_cache(self, graph):
-        if graph == self._g1:
-            return self._g1_cache
-        elif graph == self._g2:
-            return self._g2_cache
+        graphs = [(self._g1, self._proj1, self._g1_cache), (self._g2, self._proj2, self._g2_cache)]
+        node_lists = [list(g.nodes) for g, _, _ in graphs]
+        projs = [proj for _, proj, _ in graphs]
+        if self._max_workers == 1 or sum(map(len, node_lists)) < _MIN_NODES_PER_WORKER * 2:
+            all_graph_feats = [
+                _extract_graph_features(nodes, proj, self._caller_name_mapping)
+                for nodes, proj in zip(node_lists, projs)
+            ]
         else:
+            # both graphs share one pool, so neither waits for the other's workers to start and finish
+            all_graph_feats = _extract_features_in_pool(
+                node_lists, projs, self._caller_name_mapping, self._max_workers
+            )
+
+        for (_, _, cache), nodes, graph_feats in zip(graphs, node_lists, all_graph_feats):
+            for node, feats in zip(nodes, graph_feats):
+                i = cache.node_index[node]
+                cache.counts[i] = feats[:5]
+                (
+                    cache.str_consts[i], cache.num_consts[i], cache.var_names[i], cache.stack_addrs[i],
+                    cache.func_names[i],
+                ) = feats[5:]
+
+            self._generate_feature_sets(cache)
+
+    def _generate_feature_sets(self, cache: FeatCache):
+        for i in range(len(cache.node_index)):
+            str_consts = set(cache.str_consts[i])
+            if self._use_var_names:
+                str_consts.update(cache.var_names[i])
+            if self._use_caller_names:
+                str_consts.update(cache.func_names[i])
+            cache.str_const_sets[i] = frozenset(str_consts)
+            cache.num_const_sets[i] = frozenset(cache.num_consts[i]) | frozenset(cache.stack_addrs[i])
+            cache.func_name_keys[i] = tuple(sorted(cache.func_names[i]))
+
+    def _get_correct_cache(self, graph) -> FeatCache:
+        try:
+            return self._caches_by_graph_id[id(graph)]
+        except KeyError:
             raise ValueError("Graph not found")
 
     def get_number_of_arithmetic_ins(self, block, graph) -> int:
         cache = self._get_correct_cache(graph)
-        return cache[block][self.TYP_NO_ARITHMETIC_INS]
+        return int(cache.no_arith[cache.node_index[block]])
 
     def get_number_of_calls(self, block, graph) -> int:
         cache = self._get_correct_cache(graph)
-        return cache[block][self.TYP_NO_CALLS]
+        return int(cache.no_calls[cache.node_index[block]])
 
     def get_number_of_ins(self, block, graph) -> int:
         cache = self._get_correct_cache(graph)
-        return cache[block][self.TYP_NO_INS]
+        return int(cache.no_ins[cache.node_index[block]])
 
     def get_number_of_logic_ins(self, block, graph) -> int:
         cache = self._get_correct_cache(graph)
-        return cache[block][self.TYP_NO_LOGIC_INS]
+        return int(cache.no_logic[cache.node_index[block]])
 
     def get_number_of_branch_ins(self, block, graph) -> int:
         cache = self._get_correct_cache(graph)
-        return cache[block][self.TYP_NO_BRANCH_INS]
+        return int(cache.no_branch[cache.node_index[block]])
+
+    def feature_matrix(self, graph) -> np.ndarray:
+        """
+        :return: The count features of every block in graph as a (blocks x features) matrix, with rows in the order
+                 of the graph's nodes and columns in the order of FeatCache.COUNT_FEATURES.
+        """
+        return self._get_correct_cache(graph).counts
 
     def get_str_consts(self, block, graph) -> List[str]:
         cache = self._get_correct_cache(graph)
-        str_consts = cache[block][self.TYP_STR_CONST]
+        i = cache.node_index[block]
+        str_consts = list(cache.str_consts[i])
         if self._use_var_names:
-            str_consts += cache[block][self.TYP_VAR_NAMES]
+            str_consts += cache.var_names[i]
         if self._use_caller_names:
-            str_consts += cache[block][self.TYP_FUNC_NAMES]
+            str_consts += cache.func_names[i]
 
         return str_consts
 
     def get_num_consts(self, block, graph) -> List[int]:
         cache = self._get_correct_cache(graph)
-        return cache[block][self.TYP_NUM_CONST] + cache[block][self.TYP_STACK_ADDRS]
+        i = cache.node_index[block]
+        return list(cache.num_consts[i] + cache.stack_addrs[i])
+
+    #
+    # Bulk scoring
+    #
+
+    def generate_similarities(self, get_best_inv_map=False):
+        if self._use_new_weights:
+            # the topological distance feature is not part of the feature cache
+            return super().generate_similarities(get_best_inv_map=get_best_inv_map)
+
+        scores = self.score_all_pairs(np.arange(len(self._g1_nodes)), np.arange(len(self._g2_nodes)))
+        b1_to_b2_scores = defaultdict(dict)
+        for b1, b1_scores in zip(self._g1_nodes, scores.tolist()):
+            b1_to_b2_scores[b1] = dict(zip(self._g2_nodes, b1_scores))
+
+        if not get_best_inv_map:
+            return b1_to_b2_scores
+
+        # for each b2, the first b1 with the highest (non-zero) score
+        best_b2_scores = {}
+        if scores.size:
+            best_b1_ids = scores.argmax(axis=0)
+            for b2_id, b2 in enumerate(self._g2_nodes):
+                b1_id = best_b1_ids[b2_id]
+                if scores[b1_id, b2_id] > 0:
+                    best_b2_scores[b2] = self._g1_nodes[b1_id]
+
+        return b1_to_b2_scores, best_b2_scores
+
+    def score_all_pairs(self, g1_ids: np.ndarray, g2_ids: np.ndarray) -> np.ndarray:
+        """
+        Computes block_similarity for every pair of blocks in g1_ids x g2_ids, where the ids are rows in the
+        feature caches of g1 and g2 (i.e., indexes into the graph node lists).
+
+        :return: A len(g1_ids) x len(g2_ids) matrix of similarity scores
+        """
+        c1, c2 = self._g1_cache, self._g2_cache
+        numerator = np.zeros((len(g1_ids), len(g2_ids)), dtype=np.float64)
+        denominator = np.zeros_like(numerator)
+        # features that are a single value
+        counts1 = c1.counts[g1_ids].astype(np.int64)
+        counts2 = c2.counts[g2_ids].astype(np.int64)
+        for col, weight in enumerate((
+            self.W_NO_ARITHMETIC_INS, self.W_NO_CALLS, self.W_NO_INS, self.W_NO_LOGIC_INS, self.W_NO_BRANCH_INS,
+        )):
+            f1 = counts1[:, col, None]
+            f2 = counts2[None, :, col]
+            numerator += weight * np.abs(f1 - f2)
+            denominator += weight * np.maximum(f1, f2)
+
+        # features that are a list, scored by jaccard similarity
+        for sets1, sets2, weight in (
+            (self._str_const_sets(c1, g1_ids), self._str_const_sets(c2, g2_ids), self.W_STR_CONST),
+            (self._num_const_sets(c1, g1_ids), self._num_const_sets(c2, g2_ids), self.W_NUM_CONST),
+        ):
+            union = np.empty_like(numerator)
+            intersection = np.empty_like(numerator)
+            for i, s1 in enumerate(sets1):
+                for j, s2 in enumerate(sets2):
+                    union[i, j] = len(s1 | s2)
+                    intersection[i, j] = len(s1 & s2)
+            numerator += (union - intersection) * weight
+            denominator += union * weight
+
+        # denominator == 0 when two empty blocks compared, they are equal
+        dissimilarity = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+        return 1 - dissimilarity
+
+    @staticmethod
+    def _str_const_sets(cache: FeatCache, ids) -> List[frozenset]:
+        return [cache.str_const_sets[i] for i in ids]
+
+    @staticmethod
+    def _num_const_sets(cache: FeatCache, ids) -> List[frozenset]:
+        return [cache.num_const_sets[i] for i in ids]
+
+
+#
+# Feature extraction
+#
+
+def _make_feature_extractor(proj, call_name_fallback):
+    # ailment is only needed once a matcher is made
+    from .feat_extractor import AILBlockFeatureExtractor
+
+    proj_cfg = proj.kb.cfgs.get_most_accurate() if proj is not None else None
+    return AILBlockFeatureExtractor(proj, proj_cfg, call_name_fallback=call_name_fallback)
+
+
+def _extract_block_features(extractor, node) -> Tuple:
+    """
+    Walks a single block and returns its features in the column order of FeatCache.
+    """
+    extractor.reset()
+    extractor.walk(node)
+    # the extractor's lists are reused for the next node, so keep copies
+    return (
+        len(extractor.arith_ins),
+        len(extractor.calls),
+        len(extractor.ins),
+        len(extractor.logic_ins),
+        len(extractor.branch_ins),
+        tuple(extractor.str_consts),
+        tuple(extractor.num_consts),
+        tuple(extractor.var_names),
+        tuple(extractor.stack_addrs),
+        tuple(extractor.call_names),
+    )
+
+
+def _extract_graph_features(nodes, proj, call_name_fallback) -> List[Tuple]:
+    extractor = _make_feature_extractor(proj, call_name_fallback)
+    return [_extract_block_features(extractor, node) for node in nodes]
+
+
+def _extract_features_in_pool(node_lists, projs, call_name_fallback, max_workers=None) -> List[List[Tuple]]:
+    """
+    Extracts the features of every block of every graph in separate processes, where node_lists[i] are the
+    blocks of a graph from projs[i]. Each Project is pickled once and unpickled once per worker, so strings and
+    call names resolve exactly as they do in this process.
+    """
+    # graphs from the same Project share its pickle and its extractor in the workers
+    unique_projs = []
+    proj_idxs = []
+    for proj in projs:
+        for i, unique_proj in enumerate(unique_projs):
+            if unique_proj is proj:
+                break
+        else:
+            i = len(unique_projs)
+            unique_projs.append(proj)
+        proj_idxs.append(i)
+
+    projs_bytes = [pickle.dumps(proj, protocol=5) if proj is not None else None for proj in unique_projs]
+    extractor_idxs = [proj_idxs[graph_idx] for graph_idx, nodes in enumerate(node_lists) for _ in nodes]
+    all_nodes = [node for nodes in node_lists for node in nodes]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(all_nodes) // _MIN_NODES_PER_WORKER)
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_feature_worker, initargs=(projs_bytes, call_name_fallback)
+    ) as executor:
+        all_feats = iter(executor.map(
+            _extract_in_worker, extractor_idxs, all_nodes, chunksize=_MIN_NODES_PER_WORKER
+        ))
+        return [[next(all_feats) for _ in nodes] for nodes in node_lists]
+
+
+def _init_feature_worker(projs_bytes: List[Optional[bytes]], call_name_fallback):
+    global _WORKER_EXTRACTORS
+    _WORKER_EXTRACTORS = [
+        _make_feature_extractor(pickle.loads(proj_bytes) if proj_bytes is not None else None, call_name_fallback)
+        for proj_bytes in projs_bytes
+    ]
+
+
+def _extract_in_worker(extractor_idx: int, node) -> Tuple:
+    return _extract_block_features(_WORKER_EXTRACTORS[extractor_idx], node)
@@ -1,31 +1,44 @@
-from typing import Optional, Any
+from typing import Optional, Any, Dict
 
 from ailment import BinaryOp, UnaryOp, Assignment
 from ailment.block_walker import AILBlockWalkerBase
 from ailment.block import Block
 from ailment.statement import Call, ConditionalJump, Statement, Store
-from ailment.expression import Const, StackBaseOffset, BasePointerOffset, Load
+from ailment.expression import Const, Convert, StackBaseOffset, BasePointerOffset, Load
 
 from .prettyify_ail import string_at_addr
 
+_SENTINEL = object()
+
 
 class AILBlockFeatureExtractor(AILBlockWalkerBase):
     """
     Extracts features from AIL blocks based on discoveRE features
     """
-    LOGIC_INS_TYPS = {
+    LOGIC_INS_TYPS = frozenset({
         "LogicalAnd", "LogicalOr", "CmpF", "CmpEQ", "CmpNE", "CmpLT", "CmpLE", "CmpGT", "CmpGE", "CmpLTs",
         "CmpLEs", "CmpGTs", "CmpGEs"
-    }
-    ARITH_INS_TYPS = {
+    })
+    ARITH_INS_TYPS = frozenset({
         "Add", "AddF", "Sub", "SubF", "Mul", "MulF", "Div", "DivF", "DivMo", "Mod", "Xor", "And",
         "Or", "Shl", "Shr", "Sar", "Ror", "Rol", "Not"
-    }
+    })
 
     def __init__(self, project=None, project_cfg=None, call_name_fallback=None):
         self._project = project
         self._project_cfg = project_cfg
         self._call_name_fallback_addrs = call_name_fallback or {}
+        self._stack_call_name_fallback = self._stack_fallback_by_offset(self._call_name_fallback_addrs)
+        # strings can only be recovered with both a project and its CFG
+        self._resolve_strings = project is not None and project_cfg is not None
+        # any string the CFG knows of is in loaded memory, so consts outside of it (most small ints) are skipped
+        self._min_str_addr = project.loader.min_addr if self._resolve_strings else 0
+        self._max_str_addr = project.loader.max_addr if self._resolve_strings else -1
+        # const value -> string at that address (or None). this only depends on the project, so it is kept
+        # across reset() and shared by every block the extractor walks
+        self._str_cache: Dict[int, Optional[str]] = {}
+        # call target address -> resolved function name (or None), kept across reset() like _str_cache
+        self._call_name_cache: Dict[int, Optional[str]] = {}
 
         # features
         self.arith_ins = []
@@ -38,80 +51,151 @@ class AILBlockFeatureExtractor(AILBlockWalkerBase):
         self.stack_addrs = []
         self.var_names = []
         self.call_names = []
+        # the handlers run for every expression, so the appends are bound once. reset() clears the lists in
+        # place, which keeps these valid
+        self._append_arith_ins = self.arith_ins.append
+        self._append_calls = self.calls.append
+        self._append_ins = self.ins.append
+        self._append_logic_ins = self.logic_ins.append
+        self._append_branch_ins = self.branch_ins.append
+        self._append_str_consts = self.str_consts.append
+        self._append_num_consts = self.num_consts.append
+        self._append_stack_addrs = self.stack_addrs.append
+        self._append_var_names = self.var_names.append
+        self._append_call_names = self.call_names.append
 
         super().__init__()
         self.expr_handlers[StackBaseOffset] = self._handle_StackBaseOffset
+        if not self._resolve_strings:
+            # every const is a number, so skip the string checks entirely
+            self.expr_handlers[Const] = self._handle_Const_num_only
+
+    def reset(self):
+        """
+        Clears all features collected so far, so the extractor can be reused on another block.
+        """
+        self.arith_ins.clear()
+        self.calls.clear()
+        self.ins.clear()
+        self.logic_ins.clear()
+        self.branch_ins.clear()
+        self.str_consts.clear()
+        self.num_consts.clear()
+        self.stack_addrs.clear()
+        self.var_names.clear()
+        self.call_names.clear()
+
+    def walk(self, block: Block):
+        # the extractor never edits the block, so statements are dispatched in one plain loop rather than through
+        # the base walker's re-checked index loop and _handle_stmt
+        stmt_handlers = self.stmt_handlers
+        ins_append = self._append_ins
+        for stmt_idx, stmt in enumerate(block.statements):
+            ins_append(stmt)
+            handler = stmt_handlers.get(type(stmt), None)
+            if handler is not None:
+                handler(stmt_idx, stmt, block)
+
+    def _walk_exprs(self, exprs, stmt_idx: int, stmt: Statement, block: Optional[Block]):
+        """
+        Dispatches each child expression straight to its handler, which is what the base walker's handlers do
+        through _handle_expr.
+        """
+        expr_handlers = self.expr_handlers
+        for expr_idx, expr in enumerate(exprs):
+            handler = expr_handlers.get(type(expr), None)
+            if handler is not None:
+                handler(expr_idx, expr, stmt_idx, stmt, block)
 
     def _handle_stmt(self, stmt_idx: int, stmt: Statement, block: Optional[Block]) -> Any:
-        self.ins.append(stmt)
+        # only reached for statements nested in expressions, walk() handles the statements of a block
+        self._append_ins(stmt)
         return super()._handle_stmt(stmt_idx, stmt, block)
 
+    #
+    # Statements
+    #
+
+    def _handle_ConditionalJump(self, stmt_idx: int, stmt: ConditionalJump, block: Optional[Block]):
+        self._append_branch_ins(stmt)
+        self._walk_exprs((stmt.condition, stmt.true_target, stmt.false_target), stmt_idx, stmt, block)
+
+    def _handle_Call(self, stmt_idx: int, stmt: "Call", block: Optional["Block"]):
+        self._append_calls(stmt)
+        func_name = self._resolve_call_name(stmt)
+        if func_name is not None:
+            self._append_call_names(func_name)
+        self._walk_exprs(stmt.args or (), stmt_idx, stmt, block)
+
+    def _handle_Store(self, stmt_idx: int, stmt: Store, block: Optional[Block]):
+        if stmt.variable is not None and stmt.variable.name is not None:
+            self._append_var_names(stmt.variable.name)
+
+        self._walk_exprs((stmt.addr, stmt.data), stmt_idx, stmt, block)
+
+    def _handle_Assignment(self, stmt_idx: int, stmt: Assignment, block: Optional[Block]):
+        if hasattr(stmt.dst, "variable") and stmt.dst.variable is not None and stmt.dst.variable.name is not None:
+            self._append_var_names(stmt.dst.variable.name)
+
+        if hasattr(stmt.src, "variable") and stmt.src.variable is not None and stmt.src.variable.name is not None:
+            self._append_var_names(stmt.src.variable.name)
+
+        self._walk_exprs((stmt.dst, stmt.src), stmt_idx, stmt, block)
+
+    #
+    # Expr
+    #
+
     def _handle_BinaryOp(self, expr_idx: int, expr: BinaryOp, stmt_idx: int, stmt: Statement, block: Optional[Block]):
-        if expr.op in self.ARITH_INS_TYPS:
-            self.arith_ins.append(expr)
-        elif expr.op in self.LOGIC_INS_TYPS:
-            self.logic_ins.append(expr)
-        return super()._handle_BinaryOp(expr_idx, expr, stmt_idx, stmt, block)
+        op = expr.op
+        if op in self.ARITH_INS_TYPS:
+            self._append_arith_ins(expr)
+        elif op in self.LOGIC_INS_TYPS:
+            self._append_logic_ins(expr)
+        self._walk_exprs(expr.operands, stmt_idx, stmt, block)
 
     def _handle_UnaryOp(self, expr_idx: int, expr: UnaryOp, stmt_idx: int, stmt: Statement, block: Optional[Block]):
         if expr.op in self.ARITH_INS_TYPS:
-            self.logic_ins.append(expr)
-        return super()._handle_UnaryOp(expr_idx, expr, stmt_idx, stmt, block)
+            self._append_logic_ins(expr)
+        self._walk_exprs((expr.operand,), stmt_idx, stmt, block)
 
-    def _handle_ConditionalJump(self, stmt_idx: int, stmt: ConditionalJump, block: Optional[Block]):
-        self.branch_ins.append(stmt)
-        return super()._handle_ConditionalJump(stmt_idx, stmt, block)
+    def _handle_Convert(self, expr_idx: int, expr: Convert, stmt_idx: int, stmt: Statement, block: Optional[Block]):
+        self._walk_exprs((expr.operand,), stmt_idx, stmt, block)
 
     def _handle_CallExpr(self, expr_idx: int, expr: "Call", stmt_idx: int, stmt, block: Optional["Block"]):
-        self.calls.append(expr)
+        self._append_calls(expr)
         func_name = self._resolve_call_name(expr)
         if func_name is not None:
-            self.call_names.append(func_name)
-        super()._handle_CallExpr(expr_idx, expr, stmt_idx, stmt, block)
-
-    def _handle_Call(self, stmt_idx: int, stmt: "Call", block: Optional["Block"]):
-        self.calls.append(stmt)
-        func_name = self._resolve_call_name(stmt)
-        if func_name is not None:
-            self.call_names.append(func_name)
-        super()._handle_Call(stmt_idx, stmt, block)
+            self._append_call_names(func_name)
+        self._walk_exprs(expr.args or (), stmt_idx, stmt, block)
 
     def _handle_Const(self, expr_idx: int, expr: "Const", stmt_idx: int, stmt: Statement, block: Optional[Block]):
-        if self._project is not None and self._project_cfg is not None:
-            str_val = string_at_addr(self._project_cfg, expr.value, self._project, max_size=200)
+        if self._min_str_addr <= expr.value <= self._max_str_addr:
+            str_val = self._str_cache.get(expr.value, _SENTINEL)
+            if str_val is _SENTINEL:
+                str_val = string_at_addr(self._project_cfg, expr.value, self._project, max_size=200)
+                # float values compare equal to ints (1.0 == 1), so only int values are cached
+                if type(expr.value) is int:
+                    self._str_cache[expr.value] = str_val
             if str_val is not None:
-                self.str_consts.append(str_val)
+                self._append_str_consts(str_val)
             else:
-                self.num_consts.append(expr.value)
+                self._append_num_consts(expr.value)
         else:
-            self.num_consts.append(expr.value)
+            self._append_num_consts(expr.value)
 
-        return super()._handle_Const(expr_idx, expr, stmt_idx, stmt, block)
+    def _handle_Const_num_only(self, expr_idx: int, expr: "Const", stmt_idx: int, stmt: Statement, block: Optional[Block]):
+        self._append_num_consts(expr.value)
 
     def _handle_StackBaseOffset(self, expr_idx: int, expr: "StackBaseOffset", stmt_idx: int, stmt: Statement, block: Optional[Block]):
-        self.stack_addrs.append(expr.offset)
+        self._append_stack_addrs(expr.offset)
         return None
 
-    def _handle_Store(self, stmt_idx: int, stmt: Store, block: Optional[Block]):
-        if stmt.variable is not None and stmt.variable.name is not None:
-            self.var_names.append(stmt.variable.name)
-
-        return super()._handle_Store(stmt_idx, stmt, block)
-
     def _handle_Load(self, expr_idx: int, expr: Load, stmt_idx: int, stmt: Statement, block: Optional[Block]):
         if hasattr(expr, "variable") and expr.variable is not None and expr.variable.name is not None:
-            self.var_names.append(expr.variable.name)
-
-        return super()._handle_Load(expr_idx, expr, stmt_idx, stmt, block)
-
-    def _handle_Assignment(self, stmt_idx: int, stmt: Assignment, block: Optional[Block]):
-        if hasattr(stmt.dst, "variable") and stmt.dst.variable is not None and stmt.dst.variable.name is not None:
-            self.var_names.append(stmt.dst.variable.name)
+            self._append_var_names(expr.variable.name)
 
-        if hasattr(stmt.src, "variable") and stmt.src.variable is not None and stmt.src.variable.name is not None:
-            self.var_names.append(stmt.src.variable.name)
-
-        return super()._handle_Assignment(stmt_idx, stmt, block)
+        self._walk_exprs((expr.addr,), stmt_idx, stmt, block)
 
     #
     # utils
@@ -121,13 +205,39 @@ class AILBlockFeatureExtractor(AILBlockWalkerBase):
         func_name = None
         if isinstance(call_expr.target, Const):
             func_addr = call_expr.target.value
-            if self._project is not None and func_addr in self._project.kb.functions and not self._project.kb.functions[func_addr].name.startswith("sub_"):
-                func_name = self._project.kb.functions[func_addr].name
-            elif func_addr in self._call_name_fallback_addrs:
-                func_name = self._call_name_fallback_addrs[func_addr]
+            func_name = self._call_name_cache.get(func_addr, _SENTINEL)
+            if func_name is _SENTINEL:
+                func_name = self._resolve_func_addr_name(func_addr)
+                self._call_name_cache[func_addr] = func_name
         if isinstance(call_expr.target, Load) and isinstance(call_expr.target.addr, StackBaseOffset):
-            # convert to lookup format
-            k = f"s_{hex(call_expr.target.addr.offset)}"
-            func_name = self._call_name_fallback_addrs.get(k, None)
+            func_name = self._stack_call_name_fallback.get(call_expr.target.addr.offset, None)
 
         return func_name
+
+    def _resolve_func_addr_name(self, func_addr):
+        if self._project is not None and func_addr in self._project.kb.functions:
+            func_name = self._project.kb.functions[func_addr].name
+            if not func_name.startswith("sub_"):
+                return func_name
+
+        return self._call_name_fallback_addrs.get(func_addr, None)
+
+    @staticmethod
+    def _stack_fallback_by_offset(call_name_fallback) -> Dict[int, str]:
+        """
+        Stack slots are named in the fallback mapping as "s_" + hex(offset). Index them by the offset itself so
+        calls through a stack slot don't need to format the key.
+        """
+        by_offset = {}
+        for k, name in call_name_fallback.items():
+            if not isinstance(k, str) or not k.startswith("s_"):
+                continue
+            try:
+                offset = int(k[2:], 16)
+            except ValueError:
+                continue
+            # only keys in the exact lookup format could ever match
+            if k == f"s_{hex(offset)}":
+                by_offset[offset] = name
+
+        return by_offset
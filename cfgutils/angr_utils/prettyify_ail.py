@@ -19,14 +19,22 @@ def is_printable(ch):
     return 32 <= ch < 127
 
 
+class _DisplayTable(dict):
+    """
+    A str.translate table that escapes every char that is not printable. Chars are added as they are first seen,
+    since any code point may show up.
+    """
+
+    def __missing__(self, char):
+        self[char] = ch = chr(char) if is_printable(char) else "\\x%0.2x" % char
+        return ch
+
+
+_DISPLAY_TABLE = _DisplayTable({ord("\r"): "\\r", ord("\n"): "\\n", ord("\t"): "\\t"})
+
+
 def filter_string_for_display(s):
-    output = ""
-    for ch in s.replace("\r", "\\r").replace("\n", "\\n").replace("\t", "\\t"):
-        char = ord(ch)
-        if not is_printable(char):
-            ch = "\\x%0.2x" % char
-        output += ch
-    return output
+    return s.translate(_DISPLAY_TABLE)
 
 
 def fast_memory_load_pointer(project, addr, size=None):
@@ -68,303 +76,222 @@ def string_at_addr(cfg, addr, project, max_size=50):
 
 
 #
-# Pretty Printing Classes
+# Pretty Printing
 #
 
 class OutputBuffer:
     def __init__(self):
-        self.text = ""
+        # text is only read once rendering is done, so fragments are joined then instead of on every insert
+        self._chunks = []
         self.position = 0
 
+    @property
+    def text(self):
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
     def insertText(self, text):
-        self.text += text
+        self._chunks.append(text)
         self.position += len(text)
 
-    def newline(self):
-        self.insertText("\n")
-
-
-class PrettyBlockCodeObj:
-    def __init__(self, obj: Any, project: Any, cfg: Any, *args, **kwargs):
-        self.obj = obj
-        self.project = project
-        self.cfg = cfg
-        self.span = None
-        self.subobjs = []
-        self.create_subobjs(obj)
-
-    def create_subobjs(self, obj: Any):
-        raise NotImplementedError()
-
-    def recreate_subobjs(self):
-        self.subobjs.clear()
-        self.create_subobjs(self.obj)
-
-    def render(self, output_buffer):
-        """
-        Add each subobject to the document
-        """
-        self.recreate_subobjs()
-        span_min = output_buffer.position
-        for obj in self.subobjs:
-            if type(obj) is str:
-                output_buffer.insertText(obj)
-            else:
-                obj.render(output_buffer)
-        span_max = output_buffer.position
-        self.span = (span_min, span_max)
-
-    def _add_subobj(self, subobj):
-        self.subobjs.append(subobj)
-
-    def add_text(self, text: str):
-        """
-        Add a text leaf
-        """
-        self._add_subobj(text)
-
-    def add_variable(self, var):
-        self._add_subobj(PrettyVariableObj(var, self.project, self.cfg))
-
-
-class PrettyAilObj(PrettyBlockCodeObj):
-    """
-    Renders an AIL object
-    """
-
-    def __init__(self, obj: Any, project: Any, cfg: Any, *args, stmt=None, **kwargs):
-        self.stmt = stmt or obj
-        super().__init__(obj, project, cfg, *args, **kwargs)
+    def mark(self) -> int:
+        return len(self._chunks)
 
-    def create_subobjs(self, obj: Any):
-        self.add_ailobj(obj)
-
-    def add_ailobj(self, obj: Any):
+    def text_since(self, mark: int) -> str:
         """
-        Map appropriate AIL type to the display type
+        The text inserted after mark() returned mark. Only valid while rendering, before text is read.
         """
-        subobjcls = {
-            ailment.statement.Assignment: PrettyAilAssignmentObj,
-            ailment.statement.Store: PrettyAilStoreObj,
-            ailment.statement.Jump: PrettyAilJumpObj,
-            ailment.statement.ConditionalJump: PrettyAilConditionalJumpObj,
-            ailment.statement.Return: PrettyAilReturnObj,
-            ailment.statement.Call: PrettyAilCallObj,
-            ailment.expression.Const: PrettyAilConstObj,
-            ailment.expression.Tmp: PrettyAilTmpObj,
-            ailment.expression.Register: PrettyAilRegisterObj,
-            ailment.expression.UnaryOp: PrettyAilUnaryOpObj,
-            ailment.expression.BinaryOp: PrettyAilBinaryOpObj,
-            ailment.expression.Convert: PrettyAilConvertObj,
-            ailment.expression.Load: PrettyAilLoadObj,
-        }.get(type(obj), PrettyAilTextObj)
-        subobj = subobjcls(obj, self.project, self.cfg, stmt=self.stmt)
-        self._add_subobj(subobj)
-
-
-class PrettyAilTextObj(PrettyAilObj):
-    """
-    Renders an AIL object via __str__
-    """
+        return "".join(self._chunks[mark:])
 
-    def create_subobjs(self, obj: Any):
-        self.add_text(str(obj))
+    def newline(self):
+        self.insertText("\n")
 
 
-class PrettyAilAssignmentObj(PrettyAilTextObj):
+class AilRenderer:
     """
-    Renders an ailment.statement.Assignment
+    Renders AIL objects into an OutputBuffer. Each AIL type is written by its emitter in _AIL_EMITTERS, which
+    recurses into the children through emit, so rendering a statement only creates this one object.
     """
 
-    def create_subobjs(self, obj: ailment.statement.Assignment):
-        self.add_ailobj(obj.dst)
-        self.add_text(" = ")
-        self.add_ailobj(obj.src)
+    __slots__ = ("buffer", "project", "cfg", "stmt", "render_cache")
 
+    def __init__(self, buffer: OutputBuffer, project: Any, cfg: Any, stmt: Any, render_cache=None):
+        self.buffer = buffer
+        self.project = project
+        self.cfg = cfg
+        # the statement being rendered, calls render differently when they are the statement
+        self.stmt = stmt
+        # id of an AIL expression -> its rendered text, shared by every statement rendered for the same graph
+        self.render_cache = render_cache
+
+    def emit(self, obj: Any):
+        emitter = _AIL_EMITTERS.get(type(obj), _emit_text)
+        # expressions render the same wherever they show up, so each one is only rendered once per cache
+        cache = self.render_cache
+        if cache is None or obj is self.stmt:
+            emitter(self, obj)
+            return
 
-class PrettyAilStoreObj(PrettyAilTextObj):
-    """
-    Renders an ailment.statement.Store
-    """
-
-    def create_subobjs(self, obj: ailment.statement.Store):
-        #if obj.variable is None or not self.options.show_variables:
-        if obj.variable is None:
-            self.add_text("*(")
-            self.add_ailobj(obj.addr)
-            self.add_text(") = ")
-            self.add_ailobj(obj.data)
+        text = cache.get(id(obj), None)
+        if text is None:
+            mark = self.buffer.mark()
+            emitter(self, obj)
+            cache[id(obj)] = self.buffer.text_since(mark)
         else:
-            self.add_variable(obj.variable)
-            self.add_text(" = ")
-            self.add_ailobj(obj.data)
-
-
-class PrettyAilJumpObj(PrettyAilTextObj):
-    """
-    Renders an ailment.statement.Jump
-    """
+            self.buffer.insertText(text)
 
-    def create_subobjs(self, obj: ailment.statement.Jump):
-        self.add_text("goto ")
-        self.add_ailobj(obj.target)
 
+#
+# Emitters
+#
 
-class PrettyAilConditionalJumpObj(PrettyAilTextObj):
-    """
-    Renders an ailment.statement.ConditionalJump
-    """
-
-    def create_subobjs(self, obj: ailment.statement.ConditionalJump):
-        self.add_text("if ")
-        self.add_ailobj(obj.condition)
-
-        #if self.options.show_conditional_jump_targets:
-        self.add_text(" goto ")
-        self.add_ailobj(obj.true_target)
-        self.add_text(" else goto ")
-        self.add_ailobj(obj.false_target)
-
-
-class PrettyAilReturnObj(PrettyAilTextObj):
-    """
-    Renders an ailment.statement.Return
-    """
-
-    def create_subobjs(self, obj: ailment.statement.Return):
-        self.add_text("return ")
-        for expr in obj.ret_exprs:
-            self.add_ailobj(expr)
-
+def _emit_text(r: AilRenderer, obj: Any):
+    r.buffer.insertText(str(obj))
 
-class PrettyAilCallObj(PrettyAilTextObj):
-    """
-    Renders an ailment.statement.Call
-    """
 
-    def create_subobjs(self, obj: ailment.statement.Call):
-        if obj.ret_expr is not None and self.stmt is self.obj:
-            self.add_ailobj(obj.ret_expr)
-            self.add_text(" = ")
-        self.add_ailobj(obj.target)
-        self.add_text("(")
-        if obj.args:
-            for i, arg in enumerate(obj.args):
-                if i > 0:
-                    self.add_text(", ")
-                self.add_ailobj(arg)
-        self.add_text(")")
-
-
-class PrettyAilConstObj(PrettyAilTextObj):
-    """
-    Renders an ailment.expression.Const
-    """
+def _emit_assignment(r: AilRenderer, obj: ailment.statement.Assignment):
+    r.emit(obj.dst)
+    r.buffer.insertText(" = ")
+    r.emit(obj.src)
 
-    def create_subobjs(self, obj: ailment.expression.Const):
-        # take care of labels first
-        kb = self.project.kb
-        if obj.value in kb.labels:
-            self.add_text(kb.labels[obj.value])
-            return
 
-        data_str = string_at_addr(
-            self.cfg,
-            obj.value,
-            self.project,
-        )
-        if data_str:
-            self.add_text(data_str)
-        else:
-            self.add_text(f"{obj.value:#x}")
+def _emit_store(r: AilRenderer, obj: ailment.statement.Store):
+    #if obj.variable is None or not self.options.show_variables:
+    if obj.variable is None:
+        r.buffer.insertText("*(")
+        r.emit(obj.addr)
+        r.buffer.insertText(") = ")
+    else:
+        r.buffer.insertText(obj.variable.name + " = ")
+    r.emit(obj.data)
+
+
+def _emit_jump(r: AilRenderer, obj: ailment.statement.Jump):
+    r.buffer.insertText("goto ")
+    r.emit(obj.target)
+
+
+def _emit_conditional_jump(r: AilRenderer, obj: ailment.statement.ConditionalJump):
+    r.buffer.insertText("if ")
+    r.emit(obj.condition)
+
+    #if self.options.show_conditional_jump_targets:
+    r.buffer.insertText(" goto ")
+    r.emit(obj.true_target)
+    r.buffer.insertText(" else goto ")
+    r.emit(obj.false_target)
+
+
+def _emit_return(r: AilRenderer, obj: ailment.statement.Return):
+    r.buffer.insertText("return ")
+    for expr in obj.ret_exprs:
+        r.emit(expr)
+
+
+def _emit_call(r: AilRenderer, obj: ailment.statement.Call):
+    if obj.ret_expr is not None and r.stmt is obj:
+        r.emit(obj.ret_expr)
+        r.buffer.insertText(" = ")
+    r.emit(obj.target)
+    r.buffer.insertText("(")
+    if obj.args:
+        for i, arg in enumerate(obj.args):
+            if i > 0:
+                r.buffer.insertText(", ")
+            r.emit(arg)
+    r.buffer.insertText(")")
+
+
+def _emit_const(r: AilRenderer, obj: ailment.expression.Const):
+    # take care of labels first
+    kb = r.project.kb
+    if obj.value in kb.labels:
+        r.buffer.insertText(kb.labels[obj.value])
+        return
+
+    data_str = string_at_addr(
+        r.cfg,
+        obj.value,
+        r.project,
+    )
+    if data_str:
+        r.buffer.insertText(data_str)
+    else:
+        r.buffer.insertText(f"{obj.value:#x}")
 
 
-class PrettyAilTmpObj(PrettyAilTextObj):
-    """
-    Renders an ailment.expression.Tmp
-    """
-    pass
-
+def _emit_register(r: AilRenderer, obj: ailment.expression.Register):
+    #if obj.variable is not None and self.options.show_variables:
+    if obj.variable is not None:
+        r.buffer.insertText(obj.variable.name)
+    else:
+        s = f"{obj.reg_name}" if hasattr(obj, "reg_name") else "reg_%d<%d>" % (obj.reg_offset, obj.bits // 8)
+        r.buffer.insertText(s)
 
-class PrettyAilRegisterObj(PrettyAilTextObj):
-    """
-    Renders an ailment.expression.Register
-    """
-    def create_subobjs(self, obj: ailment.expression.Register):
-        #if obj.variable is not None and self.options.show_variables:
-        if obj.variable is not None:
-            self.add_variable(obj.variable)
-        else:
-            s = f"{obj.reg_name}" if hasattr(obj, "reg_name") else "reg_%d<%d>" % (obj.reg_offset, obj.bits // 8)
-            self.add_text(s)
 
+def _emit_unary_op(r: AilRenderer, obj: ailment.expression.UnaryOp):
+    r.buffer.insertText("(" + obj.op + " ")
+    r.emit(obj.operand)
+    r.buffer.insertText(")")
 
-class PrettyAilUnaryOpObj(PrettyAilTextObj):
-    """
-    Renders an ailment.expression.UnaryOp
-    """
 
-    def create_subobjs(self, obj: ailment.expression.UnaryOp):
-        self.add_text("(")
-        self.add_text(obj.op + " ")
-        self.add_ailobj(obj.operand)
-        self.add_text(")")
+def _emit_binary_op(r: AilRenderer, obj: ailment.expression.BinaryOp):
+    r.buffer.insertText("(")
+    r.emit(obj.operands[0])
+    verbose_op = obj.OPSTR_MAP.get(obj.verbose_op, obj.verbose_op)
+    if verbose_op is None:
+        verbose_op = "unknown_op"
+    r.buffer.insertText(" " + verbose_op + " ")
+    r.emit(obj.operands[1])
+    r.buffer.insertText(")")
 
 
-class PrettyAilBinaryOpObj(PrettyAilTextObj):
-    """
-    Renders an ailment.expression.BinaryOp
-    """
+def _emit_convert(r: AilRenderer, obj: ailment.expression.Convert):
+    r.buffer.insertText("Conv(%d->%d, " % (obj.from_bits, obj.to_bits))
+    r.emit(obj.operand)
+    r.buffer.insertText(")")
 
-    def create_subobjs(self, obj: ailment.expression.BinaryOp):
-        self.add_text("(")
-        self.add_ailobj(obj.operands[0])
-        verbose_op = obj.OPSTR_MAP.get(obj.verbose_op, obj.verbose_op)
-        if verbose_op is None:
-            verbose_op = "unknown_op"
-        self.add_text(" " + verbose_op + " ")
-        self.add_ailobj(obj.operands[1])
-        self.add_text(")")
 
+def _emit_load(r: AilRenderer, obj: ailment.expression.Load):
+    #if obj.variable is not None and self.options.show_variables:
+    if obj.variable is not None:
+        r.buffer.insertText(obj.variable.name)
+    else:
+        r.buffer.insertText("*(")
+        r.emit(obj.addr)
+        r.buffer.insertText(")")
 
-class PrettyAilConvertObj(PrettyAilTextObj):
-    """
-    Renders an ailment.expression.Convert
-    """
 
-    def create_subobjs(self, obj: ailment.expression.Convert):
-        self.add_text("Conv(%d->%d, " % (obj.from_bits, obj.to_bits))
-        self.add_ailobj(obj.operand)
-        self.add_text(")")
+# the emitter of each AIL type, anything else is rendered with _emit_text
+_AIL_EMITTERS = {
+    ailment.statement.Assignment: _emit_assignment,
+    ailment.statement.Store: _emit_store,
+    ailment.statement.Jump: _emit_jump,
+    ailment.statement.ConditionalJump: _emit_conditional_jump,
+    ailment.statement.Return: _emit_return,
+    ailment.statement.Call: _emit_call,
+    ailment.expression.Const: _emit_const,
+    ailment.expression.Tmp: _emit_text,
+    ailment.expression.Register: _emit_register,
+    ailment.expression.UnaryOp: _emit_unary_op,
+    ailment.expression.BinaryOp: _emit_binary_op,
+    ailment.expression.Convert: _emit_convert,
+    ailment.expression.Load: _emit_load,
+}
 
 
-class PrettyAilLoadObj(PrettyAilTextObj):
+def stmt_to_pretty_text(stmt, project, proj_cfg, render_cache=None):
     """
-    Renders an ailment.expression.Load
-    """
-
-    def create_subobjs(self, obj: ailment.expression.Load):
-        #if obj.variable is not None and self.options.show_variables:
-        if obj.variable is not None:
-            self.add_variable(obj.variable)
-        else:
-            self.add_text("*(")
-            self.add_ailobj(obj.addr)
-            self.add_text(")")
-
+    Renders an AIL statement the way angr-management shows it.
 
-class PrettyVariableObj(PrettyBlockCodeObj):
-    """
-    Renders a variable
+    :param render_cache: A dict to reuse rendered expressions from. The AIL objects rendered with the same cache
+                         must stay alive while it is used, since they are looked up by id. Pass the same dict for
+                         every statement of a graph to render expressions shared between statements once.
     """
-    def create_subobjs(self, obj):
-        #ident = "<%s>" % (obj.ident if obj.ident else "") if self.options.show_variable_identifiers else ""
-        ident = ""
-        self.add_text(obj.name + ident)
-
-
-def stmt_to_pretty_text(stmt, project, proj_cfg):
     output_buffer = OutputBuffer()
-    pretty_obj = PrettyAilObj(stmt, project, proj_cfg)
-    pretty_obj.render(output_buffer)
+    renderer = AilRenderer(
+        output_buffer, project, proj_cfg, stmt, render_cache=render_cache if render_cache is not None else {}
+    )
+    renderer.emit(stmt)
     return output_buffer.text
@@ -4,6 +4,7 @@ import networkx as nx
 
 from .generic_block import GenericBlock
 from .generic_statement import GenericStatement
+from .csr_graph import CSRGraph
 
 
 def numbered_edges_to_block_graph(numbered_edges: List[Tuple[int, int]]) -> nx.DiGraph:
@@ -13,46 +14,39 @@ def numbered_edges_to_block_graph(numbered_edges: List[Tuple[int, int]]) -> nx.D
     numbers for the block addresses.
     """
 
-    # find max block number to create a block dictionary
-    block_numbers = set()
+    # blocks are only made for the numbers that appear in an edge
+    int_blocks = {}
+    float_blocks = {}
+
+    def _get_block(number):
+        if type(number) is float:
+            float_str = str(number)
+            block = float_blocks.get(float_str, None)
+            if block is None:
+                idx = int(float_str.split(".")[-1])
+                block = float_blocks[float_str] = GenericBlock(int(number), idx=idx)
+        else:
+            block = int_blocks.get(number, None)
+            if block is None:
+                block = int_blocks[number] = GenericBlock(number)
+        return block
+
+    # do all normal edges, then all float edges (extra data)
+    block_edges = []
     float_edges = []
     for src, dst in numbered_edges:
-        block_numbers.add(src)
-        block_numbers.add(dst)
         if type(src) is float or type(dst) is float:
             float_edges.append((src, dst))
-
-    max_number = int(max(block_numbers))
-    # None blocks added to make indexing for the right block addr easier
-    blocks = [None] + [GenericBlock(i) for i in range(1, max_number+1)] + [None]
-
-    # do all normal edges
-    block_edges = [
-        (blocks[in_e], blocks[out_e]) for (in_e, out_e) in numbered_edges
-        if not type(in_e) is float and not type(out_e) is float
-    ]
-    # do all float edges (extra data)
-    if float_edges:
-        float_blocks = {}
-        for edge in float_edges:
-            for node in edge:
-                if type(node) is float:
-                    float_str = str(node)
-                    if float_str not in float_blocks:
-                        idx = int(float_str.split(".")[-1])
-                        float_blocks[float_str] = GenericBlock(int(node), idx=idx)
-
-        for src, dst in float_edges:
-            src_blk = float_blocks[str(src)] if type(src) is float else blocks[src]
-            dst_blk = float_blocks[str(dst)] if type(dst) is float else blocks[dst]
-            block_edges.append((src_blk, dst_blk))
+        else:
+            block_edges.append((_get_block(src), _get_block(dst)))
+    block_edges += [(_get_block(src), _get_block(dst)) for src, dst in float_edges]
 
     graph = nx.DiGraph()
     graph.add_edges_from(block_edges)
 
     # find start and ends and update their attributes
-    starts = [n for n in graph.nodes if graph.in_degree(n) == 0]
-    ends = [n for n in graph.nodes if graph.out_degree(n) == 0]
+    starts = [n for n, degree in graph.in_degree() if degree == 0]
+    ends = [n for n, degree in graph.out_degree() if degree == 0]
     for node in starts:
         node.is_entrypoint = True
     for node in ends:
@@ -0,0 +1,73 @@
+from typing import List, Optional
+
+import networkx as nx
+import numpy as np
+
+
+class CSRGraph:
+    """
+    A compact, read-only directed graph stored in Compressed Sparse Row (CSR) form. Each node is given a dense
+    integer id (its index in `nodes`), and the successors of node `i` are `indices[indptr[i]:indptr[i+1]]`.
+    This uses a few bytes per edge instead of the nested dicts of a networkx.DiGraph, which matters when holding
+    the CFGs of an entire binary in memory.
+    """
+
+    __slots__ = ("nodes", "indptr", "indices", "name", "_node_ids")
+
+    def __init__(self, nodes: List, indptr: np.ndarray, indices: np.ndarray, name: Optional[str] = None):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.name = name
+        self._node_ids = None
+
+    @classmethod
+    def from_networkx(cls, graph: nx.DiGraph, node_map: Optional[dict] = None) -> "CSRGraph":
+        """
+        Creates a CSRGraph from a networkx graph. If node_map is provided, each node of the graph is replaced
+        by node_map[node] in the new graph.
+        """
+        nodes = list(graph.nodes)
+        node_ids = {node: i for i, node in enumerate(nodes)}
+        succ = graph.succ
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int32)
+        indptr[1:] = np.cumsum(np.fromiter((len(succ[node]) for node in nodes), dtype=np.int32, count=len(nodes)))
+        indices = np.fromiter(
+            (node_ids[dst] for node in nodes for dst in succ[node]), dtype=np.int32, count=int(indptr[-1])
+        )
+        if node_map is not None:
+            nodes = [node_map[node] for node in nodes]
+
+        return cls(nodes, indptr, indices, name=getattr(graph, "name", None))
+
+    def to_networkx(self) -> nx.DiGraph:
+        graph = nx.DiGraph()
+        graph.name = self.name
+        graph.add_nodes_from(self.nodes)
+        for node_id, node in enumerate(self.nodes):
+            graph.add_edges_from((node, self.nodes[dst]) for dst in self.successors(node_id))
+
+        return graph
+
+    def node_id(self, node) -> int:
+        if self._node_ids is None:
+            self._node_ids = {n: i for i, n in enumerate(self.nodes)}
+        return self._node_ids[node]
+
+    def successors(self, node_id: int) -> np.ndarray:
+        return self.indices[self.indptr[node_id]:self.indptr[node_id + 1]]
+
+    def out_degree(self, node_id: int) -> int:
+        return int(self.indptr[node_id + 1] - self.indptr[node_id])
+
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        return len(self.indices)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return f"<CSRGraph: {self.number_of_nodes()} nodes, {self.number_of_edges()} edges>"
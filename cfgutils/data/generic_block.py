@@ -2,6 +2,17 @@ from typing import List, Optional
 
 
 class GenericBlock:
+    __slots__ = (
+        "addr",
+        "statements",
+        "idx",
+        "is_entrypoint",
+        "is_exitpoint",
+        "is_merged_node",
+        "_idx_str",
+        "_hash",
+    )
+
     def __init__(
         self, addr: int, statements: List = None, idx: Optional[int] = None, is_entrypoint: bool = False,
         is_exitpoint: bool = False, is_merged_node=False
@@ -14,12 +25,27 @@ class GenericBlock:
         self.is_merged_node = is_merged_node
 
         self._idx_str = "" if self.idx is None else f".{self.idx}"
+        # computed on the first hash, anything that changes the block after that must reset it
+        self._hash = None
+
+    def __getstate__(self):
+        # the cached hash is not kept, since str hashes differ between processes
+        return {attr: getattr(self, attr) for attr in self.__slots__ if attr != "_hash"}
+
+    def __setstate__(self, state):
+        self._hash = None
+        # also loads blocks pickled before __slots__ was used, whose state is their __dict__
+        for attr, value in state.items():
+            setattr(self, attr, value)
 
     def __eq__(self, other):
         return type(other) is self.__class__ and self.addr == other.addr and self.statements == other.statements
 
     def __hash__(self):
-        return hash(f"{self.addr}{self.idx}{[d for d in self.statements]}")
+        if self._hash is None:
+            # hash(None) is the address of None before python 3.12, so it would change between runs
+            self._hash = hash((self.addr, -1 if self.idx is None else self.idx, tuple(self.statements)))
+        return self._hash
 
     def __repr__(self):
         type_str = " (exit)" if self.is_exitpoint else " (entry)" if self.is_entrypoint else ""
@@ -53,12 +79,14 @@ class GenericBlock:
         new_node.is_entrypoint |= block2.is_entrypoint
         new_node.is_exitpoint |= block2.is_exitpoint
         new_node.is_merged_node = True
+        new_node._hash = None
         return new_node
 
     @classmethod
     def merge_many_blocks(cls, start_addr, nodes: List["GenericBlock"]):
         new_node = nodes[0].copy()
         new_node.addr = start_addr
+        new_node._hash = None
         for node in nodes[1:]:
             new_node = cls.merge_blocks(new_node, node)
 
@@ -1,21 +1,54 @@
-from typing import List
+from collections import abc
+from sys import intern
+from typing import Sequence
+
+
+def _operand_tuple(operands) -> tuple:
+    if operands is None:
+        return ()
+    if isinstance(operands, abc.Sequence) and not isinstance(operands, (str, bytes)):
+        return tuple(operands)
+    # a single operand, like the one of a unary op. a str is one operand rather than a sequence of chars
+    return (operands,)
 
 
 class GenericStatement:
-    def __init__(self, addr: int, operation: object, operands: List[object] = None):
+    __slots__ = (
+        "addr",
+        "op",
+        "operands",
+        "_hash",
+    )
+
+    def __init__(self, addr: int, operation: object, operands: Sequence[object] = None):
         self.addr = addr
-        self.op = operation
-        self.operands = operands or []
+        # ops come from a small vocabulary, so share a single copy of each
+        self.op = intern(operation) if type(operation) is str else operation
+        # operands may be given as any sequence or as a single operand, and are kept as a tuple so that [1, 2] and
+        # (1, 2) are the same operands
+        self.operands = _operand_tuple(operands)
+        # computed on the first hash
+        self._hash = None
+
+    def __getstate__(self):
+        # the cached hash is not kept, since str hashes differ between processes
+        return {attr: getattr(self, attr) for attr in self.__slots__ if attr != "_hash"}
+
+    def __setstate__(self, state):
+        self._hash = None
+        # also loads statements pickled before __slots__ was used, whose state is their __dict__
+        for attr, value in state.items():
+            setattr(self, attr, value)
+        self.operands = _operand_tuple(self.operands)
 
     def __eq__(self, other):
-        return isinstance(other, GenericStatement) and self.op == other.op and self.operands == self.operands
+        return isinstance(other, GenericStatement) and self.op == other.op and self.operands == other.operands
 
     def __hash__(self):
-        _target = hash(self.addr) + hash(self.op)
-        for operand in self.operands:
-            _target += hash(operand)
-
-        return _target
+        # equal statements can be at different addresses, so the address is not part of the hash
+        if self._hash is None:
+            self._hash = hash((self.op, self.operands))
+        return self._hash
 
     def __repr__(self):
         return self.__str__()
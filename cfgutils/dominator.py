@@ -88,29 +88,34 @@ def dfs_back_edges(graph, start_node):
     """
     Do a DFS traversal of the graph, and return with the back edges.
 
-    Note: This is just a naive recursive implementation, feel free to replace it.
     I couldn't find anything in networkx to do this functionality. Although the
     name suggest it, but `dfs_labeled_edges` is doing something different.
 
+    The traversal keeps its own stack rather than recursing, so deep graphs neither hit the recursion limit nor pass
+    every edge up a chain of nested generators. Edges come out in the same order as a recursive DFS.
+
     :param graph:       The graph to traverse.
     :param start_node:  The node where to start the traversal
     :returns:           An iterator of 'backward' edges
     """
 
-    visited = set()
+    visited = {start_node}
     finished = set()
-
-    def _dfs_back_edges_core(node):
-        visited.add(node)
-        for child in iter(graph[node]):
+    # each entry is a node being visited and an iterator over the children it has left
+    stack = [(start_node, iter(graph[start_node]))]
+    while stack:
+        node, children = stack[-1]
+        for child in children:
             if child not in finished:
                 if child in visited:
                     yield node, child
                 else:
-                    yield from _dfs_back_edges_core(child)
-        finished.add(node)
-
-    yield from _dfs_back_edges_core(start_node)
+                    visited.add(child)
+                    stack.append((child, iter(graph[child])))
+                    break
+        else:
+            finished.add(node)
+            stack.pop()
 
 
 def subgraph_between_nodes(graph, source, frontier, include_frontier=False):
@@ -189,6 +194,50 @@ def dominates(idom, dominator_node, node):
     return False
 
 
+class DominatorTreeIntervals:
+    """
+    Answers the same queries as dominates() for one immediate dominator tree, without walking up the tree each time.
+    A DFS of the tree numbers every node when it enters and when it leaves the node, so a node dominates another when
+    its interval holds the other's.
+    """
+
+    __slots__ = ("_enter", "_exit")
+
+    def __init__(self, idom):
+        children = defaultdict(list)
+        roots = []
+        for node, parent in idom.items():
+            if node == parent:
+                roots.append(node)
+            else:
+                children[parent].append(node)
+        # newer versions of networkx leave the start node out of idom instead of making it its own dominator
+        roots += [parent for parent in children if parent not in idom]
+
+        self._enter = {}
+        self._exit = {}
+        counter = 0
+        for root in roots:
+            stack = [(root, False)]
+            while stack:
+                node, leaving = stack.pop()
+                if leaving:
+                    self._exit[node] = counter
+                else:
+                    self._enter[node] = counter
+                    stack.append((node, True))
+                    stack.extend((child, False) for child in children.get(node, ()))
+                counter += 1
+
+    def dominates(self, dominator_node, node) -> bool:
+        enter = self._enter
+        if dominator_node not in enter or node not in enter:
+            # like dominates(), a node outside of the tree only dominates itself
+            return dominator_node == node
+
+        return enter[dominator_node] <= enter[node] and self._exit[node] <= self._exit[dominator_node]
+
+
 #
 # Dominance frontier
 #
@@ -237,6 +286,32 @@ def compute_dominance_frontier(graph, domtree):
     return df
 
 
+def dominance_frontiers_from_idom(graph, start, idom):
+    """
+    Compute the same dominance frontiers as networkx.dominance_frontiers(graph, start), from the immediate dominators
+    that networkx.immediate_dominators(graph, start) already returned, instead of finding them again.
+
+    :param graph:   The graph where we want to compute the dominance frontier.
+    :param start:   The start node of the dominator tree.
+    :param idom:    The immediate dominators of the graph from start.
+    :returns:       A dict of the dominance frontier of every node reachable from start
+    """
+
+    # older versions of networkx make the start node its own dominator, newer ones leave it out
+    idom = {**idom, start: None}
+
+    df = {u: set() for u in idom}
+    pred = graph.pred
+    for u in idom:
+        if u == start or len(pred[u]) >= 2:
+            for v in pred[u]:
+                if v in idom:
+                    while v != idom[u]:
+                        df[v].add(u)
+                        v = idom[v]
+    return df
+
+
 #
 # Dominators and post-dominators
 #
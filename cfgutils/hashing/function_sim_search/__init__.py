@@ -2,8 +2,8 @@ mask64bit = 0xffffffffffffffff
 mask32bit = 0xffffffff
 
 def rotl64(data, n):
-    _data = data & mask64bit
-    return ((_data & mask64bit) << n) & mask64bit
+    # the bits shifted out are dropped rather than rotated in, which the hashes depend on
+    return (data << n) & mask64bit
 
 # Some primes between 2^63 and 2^64 from CityHash.
 seed0_ = 0xc3a5c85c97cb3127
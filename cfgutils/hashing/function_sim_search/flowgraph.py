@@ -1,18 +1,25 @@
-from collections import defaultdict
+import functools
 import logging
 import re
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict
 
 import networkx as nx
 import itertools
 
 from cfgutils.sorting import quasi_topological_sort_nodes
-from . import seed0_, seed1_, seed2_, rotl64, mask64bit
-from ...data import GenericBlock
+from . import mask64bit
+from ...data import GenericBlock, CSRGraph
 
 _l = logging.getLogger(__name__)
 
-CONST_RE = r"(?:\W|0x|^)([0-9a-fA-F]+)(?:h|\W|$)"
+CONST_RE = re.compile(r"(?:\W|0x|^)([0-9a-fA-F]+)(?:h|\W|$)")
+
+
+@functools.lru_cache(maxsize=0x10000)
+def _immediates_in_string(string: str) -> Tuple[int, ...]:
+    # operand strings repeat a lot across statements and across the graphlets of a function.
+    # the captured digits are always valid hex.
+    return tuple(int(imm, 16) for imm in CONST_RE.findall(string))
 
 
 class FlowGraph:
@@ -22,18 +29,79 @@ class FlowGraph:
     - op iterations
     - immediate iteration
     """
-    def __init__(self, graph: nx.DiGraph):
+    def __init__(self, graph: nx.DiGraph, frozen_adjacency=None):
         self.graph = graph
+        self._edge_features_cache = {}
+        # the frozen_adjacency of the graph this one is a subgraph of, if any
+        self._parent_adjacency = frozen_adjacency
+
+    # the attributes below are computed on first access, since the graphlets made by GetSubgraph only need the
+    # ones used by CalculateHash
+
+    @functools.cached_property
+    def _top_ordered_nodes(self) -> List[GenericBlock]:
+        return quasi_topological_sort_nodes(self.graph)
+
+    @functools.cached_property
+    def _top_ordered_pos(self) -> Dict[GenericBlock, int]:
+        return {node: i for i, node in enumerate(self._top_ordered_nodes)}
 
-        self._top_ordered_nodes = quasi_topological_sort_nodes(graph)
-        self._addr_ordered_nodes = sorted(list(self.graph.nodes), key=lambda x: x.addr)
-        self.statements = list(itertools.chain.from_iterable([blk.statements for blk in self._addr_ordered_nodes]))
-        self._in_degrees = {node: graph.in_degree(node) for node in self._top_ordered_nodes}
-        self._out_degrees = {node: graph.out_degree(node) for node in self._top_ordered_nodes}
+    @functools.cached_property
+    def _addr_ordered_nodes(self) -> List[GenericBlock]:
+        return sorted(list(self.graph.nodes), key=lambda x: x.addr)
 
-        self.nodes_and_distance: List[Tuple[GenericBlock, int]] = self._build_nodes_and_distances()
-        self.mnemonic_ngrams: List[Tuple[str, str, str]] = self.BuildMnemonicNgrams()
-        self.immediates: List[int] = self.FindImmediateValues()
+    @functools.cached_property
+    def statements(self) -> List:
+        return list(itertools.chain.from_iterable([blk.statements for blk in self._addr_ordered_nodes]))
+
+    @functools.cached_property
+    def frozen_adjacency(self) -> Tuple[Dict[GenericBlock, int], List[List[int]], List[List[int]]]:
+        """
+        The id of every node, and the ids of the predecessors and of the successors of each node by id, read once from
+        CSRGraphs of the graph. Subgraphs made by GetSubgraph with it find their adjacency from these ids instead of
+        going through the node filters of their networkx views.
+        """
+        succ_csr = CSRGraph.from_networkx(self.graph)
+        # the reversed view lists the same nodes in the same order, so both share ids
+        pred_csr = CSRGraph.from_networkx(self.graph.reverse(copy=False))
+        node_ids = {node: i for i, node in enumerate(succ_csr.nodes)}
+        pred_rows = [pred_csr.successors(i).tolist() for i in range(len(node_ids))]
+        succ_rows = [succ_csr.successors(i).tolist() for i in range(len(node_ids))]
+        return node_ids, pred_rows, succ_rows
+
+    @functools.cached_property
+    def _adjacency_ids(self) -> Tuple[List[List[int]], List[List[int]]]:
+        """
+        The topological positions of the predecessors and of the successors of each node, by topological position.
+        """
+        if self._parent_adjacency is None:
+            pos = self._top_ordered_pos
+            graph_pred = self.graph.pred
+            graph_succ = self.graph.succ
+            pred_ids = [[pos[pred] for pred in graph_pred[node]] for node in self._top_ordered_nodes]
+            succ_ids = [[pos[succ] for succ in graph_succ[node]] for node in self._top_ordered_nodes]
+            return pred_ids, succ_ids
+
+        # a subgraph view lists the neighbors of a node in the order of the graph it is made from, skipping the ones
+        # it does not hold, so filtering the rows of that graph finds the same lists
+        node_ids, pred_rows, succ_rows = self._parent_adjacency
+        parent_ids = [node_ids[node] for node in self._top_ordered_nodes]
+        pos = {parent_id: i for i, parent_id in enumerate(parent_ids)}
+        pred_ids = [[pos[pred] for pred in pred_rows[parent_id] if pred in pos] for parent_id in parent_ids]
+        succ_ids = [[pos[succ] for succ in succ_rows[parent_id] if succ in pos] for parent_id in parent_ids]
+        return pred_ids, succ_ids
+
+    @functools.cached_property
+    def nodes_and_distance(self) -> List[Tuple[GenericBlock, int]]:
+        return self._build_nodes_and_distances()
+
+    @functools.cached_property
+    def mnemonic_ngrams(self) -> List[Tuple[str, str, str]]:
+        return self.BuildMnemonicNgrams()
+
+    @functools.cached_property
+    def immediates(self) -> List[int]:
+        return self.FindImmediateValues()
 
     def _build_nodes_and_distances(self):
         ones, twos, threes = [], [], []
@@ -73,17 +141,14 @@ class FlowGraph:
         Also removes data structure offsets, though.
         """
         immediates = []
-        for operand in itertools.chain.from_iterable([stmt.operands for stmt in self.statements]):
-            _imms = self.ExtractImmediateFromString(operand)
-            if not _imms:
-                continue
-
-            for _imm in _imms:
-                # TODO: just a rule from the original implementation... maybe remove it to get smaller imms
-                if (abs(_imm) > 0x4000) or ((_imm % 4 != 0) and (_imm > 10)):
-                    immediates.append(_imm)
+        for operand in itertools.chain.from_iterable(stmt.operands for stmt in self.statements):
+            if isinstance(operand, str):
+                immediates += _immediates_in_string(operand)
+            elif isinstance(operand, int):
+                immediates.append(operand)
 
-        return immediates
+        # TODO: just a rule from the original implementation... maybe remove it to get smaller imms
+        return [imm for imm in immediates if (abs(imm) > 0x4000) or ((imm % 4 != 0) and (imm > 10))]
 
     def ExtractImmediateFromString(self, string):
         """
@@ -94,22 +159,14 @@ class FlowGraph:
         if not isinstance(string, str):
             return []
 
-        imms = []
-        for imm in re.findall(CONST_RE, string):
-            try:
-                val = int(imm, 16)
-            except ValueError:
-                continue
-
-            imms.append(val)
-        return imms
+        return list(_immediates_in_string(string))
 
     def CalculateHash(self, start_node=None, k0=0xc3a5c85c97cb3127, k1=0xb492b66fbe98f273, k2=0x9ae16a3b2f90404f):
         """
         TODO: test this against the original function output!
         """
         if start_node is None:
-            _starts = list(node for node in self.graph.nodes if self.graph.in_degree(node) == 0)
+            _starts = [node for node, in_degree in self.graph.in_degree() if in_degree == 0]
             if len(_starts) != 1:
                 raise ValueError("Graph must have exactly one start node is none is provided")
 
@@ -118,87 +175,124 @@ class FlowGraph:
         if start_node not in self.graph.nodes:
             raise ValueError("Start node must be in the graph")
 
+        return self.HashEdgeFeatures(self.EdgeFeatures(start_node), k0=k0, k1=k1, k2=k2)
+
+    @staticmethod
+    def HashEdgeFeatures(edge_feats, k0=0xc3a5c85c97cb3127, k1=0xb492b66fbe98f273, k2=0x9ae16a3b2f90404f):
+        """
+        Hashes the edge features of a start node, as made by EdgeFeatures, the way CalculateHash does.
+        """
+        hash_result = 0x0BADDEED600DDEED
+        for source_feats, targets_feats in edge_feats:
+            src_fwd, src_back, src_both, src_in, src_out = source_feats
+            # every target adds 10 steps of (h + x) << 7, masked to 64 bits. the 70 bits of shifting push out all of
+            # the per-edge hash from before the target, so only the last target of a source is left in it, and the
+            # 0x600DDEED0BADDEED it starts from is gone too. rotl64(x, 7) is inlined, it is a masked shift.
+            dst_fwd, dst_back, dst_both, dst_in, dst_out = targets_feats[-1]
+            per_edge_hash = (((k0 * src_fwd) & mask64bit) << 7) & mask64bit
+            per_edge_hash = ((per_edge_hash + ((k1 * src_back) & mask64bit)) << 7) & mask64bit
+            per_edge_hash = ((per_edge_hash + ((k2 * src_both) & mask64bit)) << 7) & mask64bit
+            per_edge_hash = ((per_edge_hash + ((k0 * src_in) & mask64bit)) << 7) & mask64bit
+            per_edge_hash = ((per_edge_hash + ((k1 * src_out) & mask64bit)) << 7) & mask64bit
+
+            per_edge_hash = ((per_edge_hash + ((k2 * dst_fwd) & mask64bit)) << 7) & mask64bit
+            per_edge_hash = ((per_edge_hash + ((k0 * dst_back) & mask64bit)) << 7) & mask64bit
+            per_edge_hash = ((per_edge_hash + ((k1 * dst_both) & mask64bit)) << 7) & mask64bit
+            per_edge_hash = ((per_edge_hash + ((k2 * dst_in) & mask64bit)) << 7) & mask64bit
+            per_edge_hash = ((per_edge_hash + ((k0 * dst_out) & mask64bit)) << 7) & mask64bit
+
+            hash_result += per_edge_hash
+
+        return hash_result
+
+    def EdgeFeatures(self, start_node) -> List[Tuple[Tuple[int, ...], List[Tuple[int, ...]]]]:
+        """
+        Gets the (forward order, backward order, both order, in degree, out degree) of the source and targets of every
+        edge hashed by CalculateHash. They only depend on the start node, so they are computed once and shared by the
+        hashes for every seed.
+        """
+        edge_feats = self._edge_features_cache.get(start_node, None)
+        if edge_feats is not None:
+            return edge_feats
+
         # compute the topological order of the graph and reconstruct that order
         # for both the forward and backward edges based on the original code.
-        out_edges = defaultdict(list)
-        ordered_nodes = self._top_ordered_nodes[self._top_ordered_nodes.index(start_node):]
-        order_forward = {ordered_nodes[0]: 0}  # computed from out edges
-        order_backward = {}  # computed from in edges
-        order_both = {}  # computed from both edges
+        # nodes are numbered by their topological position, so the orders are lists, and -1 marks no order yet
+        pred_ids, succ_ids = self._adjacency_ids
+        n_nodes = len(pred_ids)
+        start_id = self._top_ordered_pos[start_node]
+        out_edges = []
+        order_forward = [-1] * n_nodes  # computed from out edges
+        order_backward = [-1] * n_nodes  # computed from in edges
+        order_both = [-1] * n_nodes  # computed from both edges
+        order_forward[start_id] = 0
         back_idx = 0
         fwd_idx = 1
         bi_idx = 0
-        for node in ordered_nodes:
-            for pred in self.graph.predecessors(node):
-                if pred not in order_backward:
+        for node_id in range(start_id, n_nodes):
+            for pred in pred_ids[node_id]:
+                if order_backward[pred] == -1:
                     order_backward[pred] = back_idx
                     back_idx += 1
-                if pred not in order_both:
+                if order_both[pred] == -1:
                     order_both[pred] = bi_idx
                     bi_idx += 1
-                    order_both[node] = bi_idx
+                    order_both[node_id] = bi_idx
                     bi_idx += 1
-            for succ in self.graph.successors(node):
-                out_edges[node].append(succ)
-                if succ not in order_forward:
+            succs = succ_ids[node_id]
+            if succs:
+                out_edges.append((node_id, succs))
+            for succ in succs:
+                if order_forward[succ] == -1:
                     order_forward[succ] = fwd_idx
                     fwd_idx += 1
-                if succ not in order_both:
+                if order_both[succ] == -1:
                     order_both[succ] = bi_idx
                     bi_idx += 1
-                    order_both[node] = bi_idx
+                    order_both[node_id] = bi_idx
                     bi_idx += 1
 
-        for node in ordered_nodes:
-            if node not in order_backward:
-                order_backward[node] = back_idx
+        for node_id in range(start_id, n_nodes):
+            if order_backward[node_id] == -1:
+                order_backward[node_id] = back_idx
                 back_idx += 1
 
-        hash_result = 0x0BADDEED600DDEED
-        for source, dst_nodes in out_edges.items():
-            per_edge_hash = 0x600DDEED0BADDEED
-            for target in dst_nodes:
-                per_edge_hash += (k0 * order_forward[source]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-                per_edge_hash += (k1 * order_backward[source]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-                per_edge_hash += (k2 * order_both[source]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-                per_edge_hash += (k0 * self._in_degrees[source]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-                per_edge_hash += (k1 * self._out_degrees[source]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-
-                per_edge_hash += (k2 * order_forward[target]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-                per_edge_hash += (k0 * order_backward[target]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-                per_edge_hash += (k1 * order_both[target]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-                per_edge_hash += (k2 * self._in_degrees[target]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-                per_edge_hash += (k0 * self._out_degrees[target]) & mask64bit
-                per_edge_hash = rotl64(per_edge_hash, 7)
-
-            hash_result += per_edge_hash
-
-        return hash_result
+        def _node_features(node_id):
+            feats = (
+                order_forward[node_id], order_backward[node_id], order_both[node_id], len(pred_ids[node_id]),
+                len(succ_ids[node_id])
+            )
+            if -1 in feats[:3]:
+                # nodes before the start node may never be ordered
+                raise KeyError(self._top_ordered_nodes[node_id])
+            return feats
+
+        edge_feats = [
+            (_node_features(source), [_node_features(target) for target in dst_ids])
+            for source, dst_ids in out_edges
+        ]
+        self._edge_features_cache[start_node] = edge_feats
+        return edge_feats
 
     @staticmethod
-    def GetSubgraph(graph: nx.DiGraph, node: GenericBlock, distance, max_size=30) -> Optional["FlowGraph"]:
+    def GetSubgraph(
+        graph: nx.DiGraph, node: GenericBlock, distance, max_size=30, frozen_adjacency=None
+    ) -> Optional["FlowGraph"]:
+        """
+        :param frozen_adjacency: The frozen_adjacency of the FlowGraph of graph, to share with the subgraph.
+        """
         assert node in graph
 
         total_size = len(node.statements)
         new_nodes = [node]
         # TODO: add sorter for neighbors
-        for src, succs in nx.bfs_successors(graph, node, depth_limit=distance):
-            succ: GenericBlock
-            for succ in succs:
-                new_nodes.append(succ)
-                total_size += len(succ.statements)
+        succ: GenericBlock
+        for _, succ in nx.bfs_edges(graph, node, depth_limit=distance):
+            new_nodes.append(succ)
+            total_size += len(succ.statements)
 
-                if total_size > max_size:
-                    _l.debug(f"Max size hit for the graph starting with %s of depth %s", node, distance)
-                    return None
+            if total_size > max_size:
+                _l.debug(f"Max size hit for the graph starting with %s of depth %s", node, distance)
+                return None
 
-        return FlowGraph(nx.subgraph(graph, new_nodes))
+        return FlowGraph(nx.subgraph(graph, new_nodes), frozen_adjacency=frozen_adjacency)
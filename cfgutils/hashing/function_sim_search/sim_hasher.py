@@ -1,9 +1,24 @@
+import functools
 import hashlib
+import multiprocessing
+import os
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, Optional, List, Tuple
 
+import numpy as np
+
 from .flowgraph import FlowGraph
-from . import rotl64, mask64bit, seed0_, seed1_, seed2_, k0, k1, k2, mask32bit
+from . import rotl64, mask64bit, seed0_, seed1_, seed2_, k0, k1, k2
+
+# graphlets are only spread over processes when every worker gets at least this many
+_MIN_GRAPHLETS_PER_WORKER = 128
+# (graph, nodes_and_distance, graphlet cache, frozen adjacency) of the function a worker process finds graphlets in
+_WORKER_GRAPHLET_SOURCE = None
+# workers must be forked to hash blocks the same way as this process. without fork, graphlets are found in this process
+_FORK_CONTEXT = (
+    multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+)
 
 
 class FunctionSimHasher:
@@ -11,11 +26,13 @@ class FunctionSimHasher:
     TYPE_MNEM = "mnemonic"
     TYPE_IMM = "immediate"
 
-    def __init__(self, w_graph=1.0, w_mnem=0.05, w_imm=4.0):
+    def __init__(self, w_graph=1.0, w_mnem=0.05, w_imm=4.0, max_workers: Optional[int] = 1):
         # weights
         self.w_graph = w_graph
         self.w_mnem = w_mnem
         self.w_imm = w_imm
+        # processes to find graphlets in, None for one per CPU. only used where processes can be forked
+        self.max_workers = max_workers
 
     def CalculateFunctionSimHash(self, graph, bit_size=128):
         if bit_size % 64 != 0:
@@ -23,27 +40,39 @@ class FunctionSimHasher:
 
         full_flow_graph = FlowGraph(graph)
         feature_cardnalities = defaultdict(int)
-        final_floats = [0.0]*bit_size
+        final_floats = np.zeros(bit_size, dtype=np.float64)
+        # the counter of every 64 bit word of the feature hashes
+        word_counters = [(cntr + 1) * 64 for cntr in range(bit_size // 64)]
 
         # graphlets (sub-graphs)
-        for node, dist in full_flow_graph.nodes_and_distance:
-            graphlet = full_flow_graph.GetSubgraph(graph, node, dist)
-            if graphlet is None:
+        nodes_and_distance = full_flow_graph.nodes_and_distance
+        if (
+            self.max_workers == 1 or len(nodes_and_distance) < _MIN_GRAPHLETS_PER_WORKER * 2 or
+            _FORK_CONTEXT is None
+        ):
+            graphlet_cache = {}
+            frozen_adjacency = full_flow_graph.frozen_adjacency
+            graphlets_feats = (
+                _graphlet_edge_features(graph, node, dist, graphlet_cache, frozen_adjacency)
+                for node, dist in nodes_and_distance
+            )
+        else:
+            graphlets_feats = _graphlet_edge_features_in_pool(graph, len(nodes_and_distance), self.max_workers)
+
+        for edge_feats in graphlets_feats:
+            if edge_feats is None:
                 continue
 
-            _id = self._hash_graph(graphlet, node, hash_index=0, counter=0)
+            _id = self._hash_graph(edge_feats, hash_index=0, counter=0)
             card = feature_cardnalities[_id]
             feature_cardnalities[_id] += 1
-            #feat_card_id = self._hash_graph(graphlet, node, card, 0)
+            #feat_card_id = self._hash_graph(edge_feats, card, 0)
             # XXX: since we dont support the getWeight() function, its just the weight of that feature
             weight = self.w_graph
 
             # start ProcessSubgraph here
             # calculate nbithash
-            _hashes = [
-                self._hash_graph(graphlet, node, hash_index=card, counter=(cntr + 1) * 64)
-                for cntr in range(bit_size // 64)
-            ]
+            _hashes = self._hash_graph_counters(edge_feats, hash_index=card, counters=word_counters)
             # skip adding to feature hashes
             self.AddWeightsInHashToOutput(final_floats, bit_size, weight, _hashes)
 
@@ -66,28 +95,31 @@ class FunctionSimHasher:
             card = feature_cardnalities[_id]
             feature_cardnalities[_id] += 1
             weight = self.w_imm
-            _hashes = [
-                self._hash_immediate(imm, hash_index=card, counter=(cntr + 1) * 64)
-                for cntr in range(bit_size // 64)
-            ]
+            _hashes = self._hash_immediate_counters(imm, hash_index=card, counters=word_counters)
             self.AddWeightsInHashToOutput(final_floats, bit_size, weight, _hashes)
 
         vals = self.FloatsToBits(final_floats)
         return vals[:-1]
 
-    def AddWeightsInHashToOutput(self, final_floats, bit_size, weight, hashes):
+    def AddWeightsInHashToOutput(self, final_floats: np.ndarray, bit_size, weight, hashes):
         """
-        Updates final_floats in place
+        Updates final_floats, an array of bit_size floats, in place
         """
-        for bit_n in range(bit_size):
-            if self.GetNthBit(hashes, bit_n):
-                final_floats[bit_n] += weight
-            else:
-                final_floats[bit_n] -= weight
+        n_words = (bit_size + 63) // 64
+        # like GetNthBit, only the low 64 bits of each hash are used
+        words = np.fromiter((h & mask64bit for h in hashes[:n_words]), dtype="<u8", count=n_words)
+        bits = np.unpackbits(words.view(np.uint8), bitorder="little")[:bit_size]
+        # +weight for every set bit and -weight for every other one
+        signs = bits.astype(np.float64)
+        signs *= 2.0
+        signs -= 1.0
+        final_floats += weight * signs
 
-    def _stable_hash(self, string: str) -> int:
-        b_str = string.encode()
-        return int(hashlib.md5(b_str).hexdigest(), 16)
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _stable_hash(string: str) -> int:
+        # mnemonics come from a small vocabulary, so each one is only digested once
+        return int.from_bytes(hashlib.md5(string.encode()).digest(), "big")
 
     def _hash_mnemonic_tuple(self, mnem_tuple: Tuple[str, str, str], hash_index=0):
         m0, m1, m2 = mnem_tuple
@@ -95,43 +127,58 @@ class FunctionSimHasher:
             self.SeedXForHashY(0, hash_index) ^ self.SeedXForHashY(1, hash_index) ^
             self.SeedXForHashY(2, hash_index)
         ) & mask64bit
-        value1 *= self._stable_hash(m0) & mask64bit
-        value1 = rotl64(value1, 7)
-        value1 *= self._stable_hash(m1) & mask64bit
-        value1 = rotl64(value1, 7)
-        value1 *= self._stable_hash(m2) & mask64bit
-        value1 = rotl64(value1, 7)
+        # rotl64(x, 7) is inlined, it is a masked shift
+        value1 = ((value1 * (self._stable_hash(m0) & mask64bit)) << 7) & mask64bit
+        value1 = ((value1 * (self._stable_hash(m1) & mask64bit)) << 7) & mask64bit
+        value1 = ((value1 * (self._stable_hash(m2) & mask64bit)) << 7) & mask64bit
         value1 *= (k2 * (hash_index + 1)) & mask64bit
         return value1 & mask64bit
 
     def _hash_immediate(self, immediate, hash_index=0, counter=0):
-        value1 = (
-            self.SeedXForHashY(0, hash_index) & mask64bit +
-            (counter * k0) & mask64bit +
-            (counter * k1) & mask64bit +
-            (counter * k2) & mask64bit
-        ) & mask64bit
-        value1 = rotl64(value1, 7)
-        value1 *= (immediate ^ self.SeedXForHashY(0, hash_index)) & mask64bit
-        value1 &= mask64bit
-        value1 = rotl64(value1, 7)
-        value1 *= (immediate ^ self.SeedXForHashY(1, hash_index)) & mask64bit
-        value1 &= mask64bit
-        value1 = rotl64(value1, 7)
-        value1 *= (immediate ^ self.SeedXForHashY(2, hash_index)) & mask64bit
-        value1 &= mask64bit
-        value1 = rotl64(value1, 7)
-        value1 *= ((k2 ^ immediate) * (hash_index + 1)) & mask64bit
-        value1 &= mask64bit
-        return value1
-
-    def _hash_graph(self, flow_graph: FlowGraph, start_node, hash_index=0, counter=0):
-        return flow_graph.CalculateHash(
-            start_node=start_node,
-            k0=self.SeedXForHashY(0, hash_index) * (counter + 1),
-            k1=self.SeedXForHashY(1, hash_index) * (counter + 1),
-            k2=self.SeedXForHashY(2, hash_index) * (counter + 1)
-        )
+        return self._hash_immediate_counters(immediate, hash_index, (counter,))[0]
+
+    def _hash_immediate_counters(self, immediate, hash_index, counters):
+        """
+        The _hash_immediate of immediate for each counter. Only the first step depends on the counter, so the seeds
+        and multipliers are found once for all of them.
+        """
+        seed0 = self.SeedXForHashY(0, hash_index)
+        mult0 = (immediate ^ seed0) & mask64bit
+        mult1 = (immediate ^ self.SeedXForHashY(1, hash_index)) & mask64bit
+        mult2 = (immediate ^ self.SeedXForHashY(2, hash_index)) & mask64bit
+        mult3 = ((k2 ^ immediate) * (hash_index + 1)) & mask64bit
+        hashes = []
+        for counter in counters:
+            value1 = (
+                seed0 & mask64bit +
+                (counter * k0) & mask64bit +
+                (counter * k1) & mask64bit +
+                (counter * k2) & mask64bit
+            ) & mask64bit
+            # rotl64(x, 7) is inlined, it is a masked shift, so the product does not need its own mask before it
+            value1 = (value1 << 7) & mask64bit
+            value1 = ((value1 * mult0) << 7) & mask64bit
+            value1 = ((value1 * mult1) << 7) & mask64bit
+            value1 = ((value1 * mult2) << 7) & mask64bit
+            hashes.append((value1 * mult3) & mask64bit)
+        return hashes
+
+    def _hash_graph(self, edge_feats, hash_index=0, counter=0):
+        return self._hash_graph_counters(edge_feats, hash_index, (counter,))[0]
+
+    def _hash_graph_counters(self, edge_feats, hash_index, counters):
+        """
+        The _hash_graph of edge_feats for each counter, which only scales the seeds.
+        """
+        seed0 = self.SeedXForHashY(0, hash_index)
+        seed1 = self.SeedXForHashY(1, hash_index)
+        seed2 = self.SeedXForHashY(2, hash_index)
+        return [
+            FlowGraph.HashEdgeFeatures(
+                edge_feats, k0=seed0 * (counter + 1), k1=seed1 * (counter + 1), k2=seed2 * (counter + 1)
+            )
+            for counter in counters
+        ]
 
     #
     # Bit Utils
@@ -139,14 +186,11 @@ class FunctionSimHasher:
 
     @staticmethod
     def FloatsToBits(floats: List[float]):
-        outputs = [0] * ((len(floats) // 64) + 1)
-        for index, _float in enumerate(floats):
-            vector_index = index // 64
-            bit_index = index % 64
-            if _float >= 0:
-                outputs[vector_index] |= (1 << bit_index)
-
-        return outputs
+        # one more word than needed is kept, callers slice it off
+        bits = np.zeros(((len(floats) // 64) + 1) * 64, dtype=np.uint8)
+        bits[:len(floats)] = np.asarray(floats, dtype=np.float64) >= 0
+        # bit n of a word is float n of its 64, so pack each byte LSB first and read the bytes as little-endian words
+        return np.packbits(bits, bitorder="little").view("<u8").tolist()
 
     @staticmethod
     def GetNthBit(nbit_hash: List[int], bitindex):
@@ -156,7 +200,9 @@ class FunctionSimHasher:
         return (value >> sub_word_index) & 1
 
     @staticmethod
+    @functools.lru_cache(maxsize=0x10000)
     def SeedXForHashY(seed_index, hash_index):
+        # the results are not masked to 64 bits, so they are cached as python ints rather than in a uint64 table
         if seed_index == 0:
             return rotl64(seed0_, hash_index % 7) * (hash_index + 1)
         elif seed_index == 1:
@@ -168,8 +214,52 @@ class FunctionSimHasher:
 
     @staticmethod
     def hash_distance(h1: List[int], h2: List[int]):
-        total_dist = 0
-        for _h1, _h2 in zip(h1, h2):
-            total_dist += _h1 ^ _h2
+        """
+        The hamming distance between two sim hashes, the number of bits they differ in.
+        """
+        return sum((_h1 ^ _h2).bit_count() for _h1, _h2 in zip(h1, h2))
+
+
+def _graphlet_edge_features(graph, node, dist, graphlet_cache: Dict, frozen_adjacency=None):
+    """
+    The edge features (see FlowGraph.EdgeFeatures) of the graphlet of node at dist, or None if it is too large.
+    """
+    graphlet = FlowGraph.GetSubgraph(graph, node, dist, frozen_adjacency=frozen_adjacency)
+    if graphlet is None:
+        return None
+
+    # a node's graphlet often stops growing before the largest distance. the same graphlet then reuses the features
+    # found the first time, which skips ordering its nodes again
+    graphlet_key = (node, frozenset(graphlet.graph.nodes))
+    edge_feats = graphlet_cache.get(graphlet_key, None)
+    if edge_feats is None:
+        edge_feats = graphlet_cache[graphlet_key] = graphlet.EdgeFeatures(node)
+    return edge_feats
+
+
+def _graphlet_edge_features_in_pool(graph, n_graphlets, max_workers=None):
+    """
+    Finds the edge features of every graphlet of graph in separate processes, in nodes_and_distance order. The
+    features are plain ints, so only the graph is sent to each worker. Like everything ordered by
+    quasi_topological_sort_nodes, they depend on the hashes of the blocks, so the workers are always forked to share
+    them with this process.
+    """
+    max_workers = min(max_workers or os.cpu_count() or 1, n_graphlets // _MIN_GRAPHLETS_PER_WORKER)
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=_FORK_CONTEXT, initializer=_init_graphlet_worker, initargs=(graph,)
+    ) as executor:
+        yield from executor.map(
+            _graphlet_edge_features_in_worker, range(n_graphlets), chunksize=_MIN_GRAPHLETS_PER_WORKER // 4
+        )
+
+
+def _init_graphlet_worker(graph):
+    global _WORKER_GRAPHLET_SOURCE
+    flow_graph = FlowGraph(graph)
+    _WORKER_GRAPHLET_SOURCE = graph, flow_graph.nodes_and_distance, {}, flow_graph.frozen_adjacency
+
 
-        return total_dist
\ No newline at end of file
+def _graphlet_edge_features_in_worker(graphlet_idx: int):
+    graph, nodes_and_distance, graphlet_cache, frozen_adjacency = _WORKER_GRAPHLET_SOURCE
+    node, dist = nodes_and_distance[graphlet_idx]
+    return _graphlet_edge_features(graph, node, dist, graphlet_cache, frozen_adjacency)
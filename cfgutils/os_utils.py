@@ -1,43 +1,87 @@
 from pathlib import Path
 import os
+import ctypes
 import shutil
 import signal
+import threading
 
 
 class WorkDirContext:
+    """
+    Changes into path while entered and back to the directory it was entered from on exit. The same context can be
+    entered again while it is entered.
+    """
     def __init__(self, path: Path):
         self.path = path
-        self.origin = Path(os.getcwd()).absolute()
+        # an open fd of each directory the context was entered from, so exiting does not resolve a path again
+        self._origin_fds = []
 
     def __enter__(self):
-        os.chdir(self.path)
+        origin_fd = os.open(".", os.O_RDONLY)
+        try:
+            os.chdir(self.path)
+        except BaseException:
+            os.close(origin_fd)
+            raise
+
+        self._origin_fds.append(origin_fd)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        os.chdir(self.origin)
+        origin_fd = self._origin_fds.pop()
+        try:
+            os.fchdir(origin_fd)
+        finally:
+            os.close(origin_fd)
 
 
 def force_mkdir(path: Path):
+    """
+    Makes path an empty directory, removing whatever was there first. Raises OSError if it can't be made.
+    """
     path = Path(path).expanduser().absolute()
-    if path.exists():
-        shutil.rmtree(path, ignore_errors=True)
-
-    try:
-        os.mkdir(path)
-    except Exception as e:
-        print(f"Failed to make directory because {e}")
+    # rmtree does nothing when there is no directory, so it is not checked for first. if it could not remove the
+    # directory, mkdir raises FileExistsError
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True)
 
 
 class timeout:
+    """
+    Raises TimeoutError in the thread that entered it once seconds have passed. The main thread is interrupted by
+    SIGALRM. Other threads, where signal handlers can't be set, get the error raised asynchronously by a timer thread.
+    That error only carries the default message, and it is only raised once the thread runs python code again, so a
+    blocking call is not cut short.
+    """
     def __init__(self, seconds=1, error_message='Timeout'):
         self.seconds = seconds
         self.error_message = error_message
+        self._timer = None
+        self._timer_lock = threading.Lock()
 
     def handle_timeout(self, signum, frame):
         raise TimeoutError(self.error_message)
 
     def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGALRM, self.handle_timeout)
+            signal.alarm(self.seconds)
+            return
+
+        self._timer = threading.Timer(self.seconds, self._raise_in_thread, args=(threading.get_ident(),))
+        self._timer.daemon = True
+        self._timer.start()
 
     def __exit__(self, type_, value, traceback):
-        signal.alarm(0)
+        if self._timer is None:
+            signal.alarm(0)
+            return
+
+        # the lock keeps the timer from raising once the block is done
+        with self._timer_lock:
+            self._timer.cancel()
+            self._timer = None
+
+    def _raise_in_thread(self, thread_id):
+        with self._timer_lock:
+            if self._timer is not None:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), ctypes.py_object(TimeoutError))
@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import deque
 import logging
 from typing import List, Optional, Union
 
@@ -6,7 +6,7 @@ import networkx
 
 from .graph_region import GraphRegion
 from ..data.generic_block import GenericBlock
-from ..dominator import dfs_back_edges, subgraph_between_nodes, dominates, shallow_reverse
+from ..dominator import dfs_back_edges, subgraph_between_nodes, DominatorTreeIntervals, dominance_frontiers_from_idom
 from ..sorting import quasi_topological_sort_nodes
 
 
@@ -93,28 +93,25 @@ class RegionIdentifier:
         @return: List of addr lists
         """
 
-        work_list = [self.region]
+        # regions are visited breadth first, so each level of the region tree comes before the next one
+        work_list = deque([self.region])
         block_only_regions = []
+        # GraphRegions compare by identity
         seen_regions = set()
         while work_list:
-            children_regions = []
-            for region in work_list:
-                children_blocks = []
-                for node in region.graph.nodes:
-                    if isinstance(node, GenericBlock):
-                        children_blocks.append(node.addr)
-                    elif isinstance(node, GraphRegion):
-                        if node not in seen_regions:
-                            children_regions.append(node)
-                            children_blocks.append(node.head.addr)
-                            seen_regions.add(node)
-                    else:
-                        continue
-
-                if children_blocks:
-                    block_only_regions.append(children_blocks)
-
-            work_list = children_regions
+            region = work_list.popleft()
+            children_blocks = []
+            for node in region.graph:
+                if isinstance(node, GenericBlock):
+                    children_blocks.append(node.addr)
+                elif isinstance(node, GraphRegion):
+                    if id(node) not in seen_regions:
+                        work_list.append(node)
+                        children_blocks.append(node.head.addr)
+                        seen_regions.add(id(node))
+
+            if children_blocks:
+                block_only_regions.append(children_blocks)
 
         return block_only_regions
 
@@ -184,18 +181,18 @@ class RegionIdentifier:
         loop_subgraph = self.slice_graph(graph, head, latching_nodes, include_frontier=True)
 
         # special case: any node with more than two non-self successors are probably the head of a switch-case. we
-        # should include all successors into the loop subgraph.
-        while True:
-            updated = False
-            for node in list(loop_subgraph):
-                nonself_successors = [succ for succ in graph.successors(node) if succ is not node]
-                if len(nonself_successors) > 2:
-                    for succ in nonself_successors:
-                        if not loop_subgraph.has_edge(node, succ):
-                            updated = True
-                            loop_subgraph.add_edge(node, succ, src=node, dst=succ)
-            if not updated:
-                break
+        # should include all successors into the loop subgraph. every node is only looked at once: the nodes of the
+        # slice first, then the successors added by switch heads, in the order they were added.
+        worklist = deque(loop_subgraph)
+        while worklist:
+            node = worklist.popleft()
+            nonself_successors = [succ for succ in graph.successors(node) if succ is not node]
+            if len(nonself_successors) > 2:
+                for succ in nonself_successors:
+                    if succ not in loop_subgraph:
+                        worklist.append(succ)
+                    if not loop_subgraph.has_edge(node, succ):
+                        loop_subgraph.add_edge(node, succ, src=node, dst=succ)
 
         nodes = set(loop_subgraph)
         return nodes
@@ -206,16 +203,20 @@ class RegionIdentifier:
 
         refined_loop_nodes = initial_loop_nodes.copy()
         refined_exit_nodes = initial_exit_nodes.copy()
+        # the graph does not change while refining, so its adjacency is read directly instead of through a view or an
+        # iterator made for every lookup
+        graph_pred = graph.pred
+        graph_succ = graph.succ
 
         # simple optimization: include all single-in-degree successors of existing loop nodes
         while True:
             added = set()
             for exit_node in list(refined_exit_nodes):
-                if graph.in_degree[exit_node] == 1 and graph.out_degree[exit_node] <= 1:
+                if len(graph_pred[exit_node]) == 1 and len(graph_succ[exit_node]) <= 1:
                     added.add(exit_node)
                     refined_loop_nodes.add(exit_node)
                     refined_exit_nodes |= {
-                        succ for succ in graph.successors(exit_node) if succ not in refined_loop_nodes
+                        succ for succ in graph_succ[exit_node] if succ not in refined_loop_nodes
                     }
                     refined_exit_nodes.remove(exit_node)
             if not added:
@@ -224,22 +225,25 @@ class RegionIdentifier:
         if len(refined_exit_nodes) <= 1:
             return refined_loop_nodes, refined_exit_nodes
 
-        idom = networkx.immediate_dominators(graph, head)
+        dom_intervals = DominatorTreeIntervals(networkx.immediate_dominators(graph, head))
 
         new_exit_nodes = refined_exit_nodes
         # a graph with only initial exit nodes and new loop nodes that are reachable from at least one initial exit
         # node.
         subgraph = networkx.DiGraph()
 
-        sorted_refined_exit_nodes = quasi_topological_sort_nodes(graph, refined_exit_nodes)
+        # the graph does not change while refining, so every node is ordered once and the exit nodes are kept sorted
+        # by their positions rather than by sorting the graph again each time they change
+        topo_index = {node: i for i, node in enumerate(quasi_topological_sort_nodes(graph))}
+        sorted_refined_exit_nodes = sorted(refined_exit_nodes, key=topo_index.__getitem__)
         while len(sorted_refined_exit_nodes) > 1 and new_exit_nodes:
             # visit each node in refined_exit_nodes once and determine which nodes to consider as loop nodes
             candidate_nodes = {}
             for n in list(sorted_refined_exit_nodes):
-                if all((pred is n or pred in refined_loop_nodes) for pred in graph.predecessors(n)) and dominates(
-                        idom, head, n
+                if all((pred is n or pred in refined_loop_nodes) for pred in graph_pred[n]) and (
+                        dom_intervals.dominates(head, n)
                 ):
-                    to_add = set(graph.successors(n)) - refined_loop_nodes
+                    to_add = set(graph_succ[n]) - refined_loop_nodes
                     candidate_nodes[n] = to_add
 
             # visit all candidate nodes and only consider candidates that will not be added as exit nodes
@@ -258,42 +262,50 @@ class RegionIdentifier:
                     continue
                 refined_loop_nodes.add(n)
                 sorted_refined_exit_nodes.remove(n)
-                to_add = set(graph.successors(n)) - refined_loop_nodes
+                to_add = set(graph_succ[n]) - refined_loop_nodes
                 new_exit_nodes |= to_add
                 for succ in to_add:
                     subgraph.add_edge(n, succ, src=n, dst=succ)
 
-            sorted_refined_exit_nodes += list(new_exit_nodes)
-            sorted_refined_exit_nodes = list(set(sorted_refined_exit_nodes))
-            sorted_refined_exit_nodes = quasi_topological_sort_nodes(graph, sorted_refined_exit_nodes)
+            added_exit_nodes = new_exit_nodes.difference(sorted_refined_exit_nodes)
+            if added_exit_nodes:
+                sorted_refined_exit_nodes = sorted(
+                    sorted_refined_exit_nodes + list(added_exit_nodes), key=topo_index.__getitem__
+                )
 
         refined_exit_nodes = set(sorted_refined_exit_nodes)
         refined_loop_nodes = refined_loop_nodes - refined_exit_nodes
 
         if self._largest_successor_tree_outside_loop and not refined_exit_nodes:
-            # figure out the new successor tree with the highest number of nodes
-            initial_exit_to_newnodes = defaultdict(set)
-            newnode_to_initial_exits = defaultdict(set)
-            for initial_exit in initial_exit_nodes:
-                if initial_exit in subgraph:
-                    for _, succs in networkx.bfs_successors(subgraph, initial_exit):
-                        initial_exit_to_newnodes[initial_exit] |= set(succs)
-                        for succ in succs:
-                            newnode_to_initial_exits[succ].add(initial_exit)
-
-            for newnode, exits in newnode_to_initial_exits.items():
-                for exit_ in exits:
-                    initial_exit_to_newnodes[exit_].add(newnode)
+            # figure out the new successor tree with the highest number of nodes.
+            # subgraph only has edges from loop nodes to nodes that joined the loop after them, so it is acyclic, and
+            # the new nodes reachable from a node are its successors and what they reach. they are kept as bitsets of
+            # node ids, which one pass in reverse topological order finds for every initial exit at once.
+            node_bits = {node: 1 << i for i, node in enumerate(subgraph)}
+            reachable_bits = {}
+            for node in reversed(list(networkx.topological_sort(subgraph))):
+                bits = 0
+                for succ in subgraph.succ[node]:
+                    bits |= node_bits[succ] | reachable_bits[succ]
+                reachable_bits[node] = bits
+
+            initial_exit_to_newnodes = {
+                exit_: reachable_bits[exit_] for exit_ in initial_exit_nodes if exit_ in subgraph
+            }
             if initial_exit_to_newnodes:
-                tree_sizes = {exit_: len(initial_exit_to_newnodes[exit_]) for exit_ in initial_exit_to_newnodes}
+                tree_sizes = {exit_: bits.bit_count() for exit_, bits in initial_exit_to_newnodes.items()}
                 max_tree_size = max(tree_sizes.values())
                 if list(tree_sizes.values()).count(max_tree_size) == 1:
-                    tree_size_to_exit = {v: k for k, v in tree_sizes.items()}
-                    max_size_exit = tree_size_to_exit[max_tree_size]
-                    if all(len(newnode_to_initial_exits[nn]) == 1 for nn in initial_exit_to_newnodes[max_size_exit]):
-                        refined_loop_nodes = (
-                                refined_loop_nodes - initial_exit_to_newnodes[max_size_exit] - {max_size_exit}
-                        )
+                    max_size_exit = next(exit_ for exit_, size in tree_sizes.items() if size == max_tree_size)
+                    max_tree_bits = initial_exit_to_newnodes[max_size_exit]
+                    other_trees_bits = 0
+                    for exit_, bits in initial_exit_to_newnodes.items():
+                        if exit_ is not max_size_exit:
+                            other_trees_bits |= bits
+                    # only take the tree out of the loop if no other initial exit reaches any of its nodes
+                    if not max_tree_bits & other_trees_bits:
+                        max_tree_nodes = {node for node, bit in node_bits.items() if max_tree_bits & bit}
+                        refined_loop_nodes = refined_loop_nodes - max_tree_nodes - {max_size_exit}
                         refined_exit_nodes.add(max_size_exit)
 
         return refined_loop_nodes, refined_exit_nodes
@@ -319,15 +331,22 @@ class RegionIdentifier:
         r = False
 
         while True:
-            for node in networkx.dfs_postorder_nodes(graph):
-                preds = graph.predecessors(node)
-                if len(preds) == 1:
+            # merge every node that still has a single predecessor when the walk reaches it, instead of starting a new
+            # walk after each merge. nodes made by merging are visited by the next walk.
+            merged = False
+            for node in list(networkx.dfs_postorder_nodes(graph)):
+                if node not in graph:
+                    # merged into one of its successors already
+                    continue
+                preds = list(graph.predecessors(node))
+                if len(preds) == 1 and preds[0] is not node:
                     # merge the two nodes
                     self._absorb_node(graph, preds[0], node)
-                    r = True
-                    break
-            else:
+                    merged = True
+
+            if not merged:
                 break
+            r = True
 
         return r
 
@@ -411,19 +430,21 @@ class RegionIdentifier:
         if {n for n in initial_loop_nodes if n.addr != head.addr}.intersection(self._loop_headers):
             return None
 
-        normal_entries = {n for n in graph.predecessors(head) if n not in initial_loop_nodes}
+        graph_pred = graph.pred
+        graph_succ = graph.succ
+        normal_entries = {n for n in graph_pred[head] if n not in initial_loop_nodes}
         abnormal_entries = set()
         for n in initial_loop_nodes:
             if n == head:
                 continue
-            preds = set(graph.predecessors(n))
+            preds = set(graph_pred[n])
             abnormal_entries |= preds - initial_loop_nodes
         l.debug("Normal entries %s", self._dbg_block_list(normal_entries))
         l.debug("Abnormal entries %s", self._dbg_block_list(abnormal_entries))
 
         initial_exit_nodes = set()
         for n in initial_loop_nodes:
-            succs = set(graph.successors(n))
+            succs = set(graph_succ[n])
             initial_exit_nodes |= succs - initial_loop_nodes
 
         l.debug("Initial exit nodes %s", self._dbg_block_list(initial_exit_nodes))
@@ -463,18 +484,15 @@ class RegionIdentifier:
         # we need to create a copy of the original graph if
         # - there are in edges to the head node, or
         # - there are more than one end nodes
+        # the end nodes are found before copying it, so that it is only copied once
 
         head_inedges = list(graph.in_edges(head))
-        if head_inedges:
-            # we need a copy of the graph to remove edges coming into the head
-            graph_copy = networkx.DiGraph(graph)
-            # remove any in-edge to the head node
-            for src, _ in head_inedges:
-                graph_copy.remove_edge(src, head)
-        else:
-            graph_copy = graph
-
-        endnodes = [node for node in graph_copy.nodes() if graph_copy.out_degree(node) == 0]
+        # once the in-edges to the head node are removed, the predecessors that only go to the head become end nodes
+        head_preds = graph.pred[head]
+        endnodes = [
+            node for node, out_degree in graph.out_degree()
+            if out_degree == 0 or (out_degree == 1 and node in head_preds)
+        ]
         if len(endnodes) == 0:
             # sanity check: there should be at least one end node
             #l.critical("No end node is found in a supposedly acyclic graph. Is it really acyclic?")
@@ -484,14 +502,21 @@ class RegionIdentifier:
         if len(endnodes) > 1:
             # if this graph has multiple end nodes: create a single end node
             add_dummy_endnode = True
-        elif head_inedges and len(endnodes) == 1 and endnodes[0] not in list(graph.predecessors(head)):
+        elif head_inedges and len(endnodes) == 1 and endnodes[0] not in head_preds:
             # special case: there are in-edges to head, but the only end node is not a predecessor to head.
             # in this case, we will want to put the end node and a predecessor of the head into the same region.
             add_dummy_endnode = True
 
-        if add_dummy_endnode:
+        if head_inedges or add_dummy_endnode:
             # we need a copy of the graph!
-            graph_copy = networkx.DiGraph(graph_copy)
+            graph_copy = networkx.DiGraph(graph)
+            # remove any in-edge to the head node
+            for src, _ in head_inedges:
+                graph_copy.remove_edge(src, head)
+        else:
+            graph_copy = graph
+
+        if add_dummy_endnode:
             dummy_endnode = "DUMMY_ENDNODE"
             for endnode in endnodes:
                 graph_copy.add_edge(endnode, dummy_endnode, src=endnode, dst=dummy_endnode)
@@ -500,14 +525,15 @@ class RegionIdentifier:
             dummy_endnode = None
 
         # compute dominator tree
-        doms = networkx.immediate_dominators(graph_copy, head)
+        idom = networkx.immediate_dominators(graph_copy, head)
+        doms = DominatorTreeIntervals(idom)
 
-        # compute post-dominator tree
-        inverted_graph = shallow_reverse(graph_copy)
-        postdoms = networkx.immediate_dominators(inverted_graph, endnodes[0])
+        # compute post-dominator tree. immediate dominators do not depend on the order of edges, so a reversed view
+        # works as well as a reversed copy of the graph
+        postdoms = networkx.immediate_dominators(graph_copy.reverse(copy=False), endnodes[0])
 
-        # dominance frontiers
-        df = networkx.algorithms.dominance_frontiers(graph_copy, head)
+        # dominance frontiers, from the dominator tree above rather than a new one
+        df = dominance_frontiers_from_idom(graph_copy, head, idom)
 
         # visit the nodes in post-order
         for node in networkx.dfs_postorder_nodes(graph_copy, source=head):
@@ -517,11 +543,10 @@ class RegionIdentifier:
             if cyclic and node is head:
                 continue
 
-            out_degree = graph_copy.out_degree[node]
-            if out_degree == 0:
+            if not graph_copy.succ[node]:
                 # the root element of the region hierarchy should always be a GraphRegion,
                 # so we transform it into one, if necessary
-                if graph_copy.in_degree(node) == 0 and not isinstance(node, GraphRegion):
+                if not graph_copy.pred[node] and not isinstance(node, GraphRegion):
                     subgraph = networkx.DiGraph()
                     subgraph.add_node(node, node=node)
                     self._abstract_acyclic_region(
@@ -567,7 +592,7 @@ class RegionIdentifier:
                             return True
 
                 failed_region_attempts.add((node, postdom_node))
-                if not dominates(doms, node, postdom_node):
+                if not doms.dominates(node, postdom_node):
                     break
                 if postdom_node is postdoms.get(postdom_node, None):
                     break
@@ -578,20 +603,20 @@ class RegionIdentifier:
         return False
 
     @staticmethod
-    def _check_region(graph, start_node, end_node, doms, df):
+    def _check_region(graph, start_node, end_node, doms: DominatorTreeIntervals, df):
         """
 
         :param graph:
         :param start_node:
         :param end_node:
-        :param doms:
+        :param doms:        The dominator tree of graph.
         :param df:
         :return:
         """
 
         # if the exit node is the header of a loop that contains the start node, the dominance frontier should only
         # contain the exit node.
-        if not dominates(doms, start_node, end_node):
+        if not doms.dominates(start_node, end_node):
             frontier = df.get(start_node, set())
             for node in frontier:
                 if node is not start_node and node is not end_node:
@@ -599,7 +624,7 @@ class RegionIdentifier:
 
         # no edges should enter the region.
         for node in df.get(end_node, set()):
-            if dominates(doms, start_node, node) and node is not end_node:
+            if doms.dominates(start_node, node) and node is not end_node:
                 return False
 
         # no edges should leave the region.
@@ -608,8 +633,8 @@ class RegionIdentifier:
                 continue
             if node not in df.get(end_node, set()):
                 return False
-            for pred in graph.predecessors(node):
-                if dominates(doms, start_node, pred) and not dominates(doms, end_node, pred):
+            for pred in graph.pred[node]:
+                if doms.dominates(start_node, pred) and not doms.dominates(end_node, pred):
                     return False
 
         return True
@@ -619,20 +644,22 @@ class RegionIdentifier:
 
         subgraph = networkx.DiGraph()
         frontier_edges = []
+        # the nodes are visited depth-first, last in first out, which decides the order they are added to the region
         queue = [node]
         traversed = set()
+        # callers pass the frontier as a list, which is only searched here
+        frontier_set = set(frontier)
+        graph_succ = graph.succ
 
         while queue:
             node_ = queue.pop()
-            if node_ in frontier:
+            if node_ in frontier_set:
                 continue
             traversed.add(node_)
             subgraph.add_node(node_, node=node_)
 
-            for succ in graph.successors(node_):
-                edge_data = graph.get_edge_data(node_, succ)
-
-                if node_ in frontier and succ in traversed:
+            for succ, edge_data in graph_succ[node_].items():
+                if node_ in frontier_set and succ in traversed:
                     if include_frontier:
                         # if frontier nodes are included, do not keep traversing their successors
                         # however, if it has an edge to an already traversed node, we should add that edge
@@ -644,7 +671,7 @@ class RegionIdentifier:
                 if succ is dummy_endnode:
                     continue
 
-                if succ in frontier:
+                if succ in frontier_set:
                     if not include_frontier:
                         # skip all frontier nodes
                         frontier_edges.append((node_, succ, edge_data))
@@ -673,12 +700,15 @@ class RegionIdentifier:
     ):
 
         in_edges = self._region_in_edges(graph, region, data=True)
-        out_edges = self._region_out_edges(graph, region, data=True)
 
-        nodes_set = set()
-        for node_ in list(region.graph.nodes()):
-            nodes_set.add(node_)
+        # the out-edges of each node are collected right before it is removed, in one walk over the region. removing
+        # a node only drops edges inside the region, which are not collected anyway
+        nodes_set = set(region.graph)
+        out_dsts = []
+        graph_succ = graph.succ
+        for node_ in list(region.graph):
             if node_ is not dummy_endnode:
+                out_dsts += [dst for dst in graph_succ[node_] if dst not in nodes_set]
                 graph.remove_node(node_)
 
         graph.add_node(region, node=region)
@@ -687,9 +717,8 @@ class RegionIdentifier:
             if src not in nodes_set:
                 graph.add_edge(src, region, src=src, dst=region)
 
-        for _, dst, data in out_edges:
-            if dst not in nodes_set:
-                graph.add_edge(region, dst, src=region, dst=dst)
+        for dst in out_dsts:
+            graph.add_edge(region, dst, src=region, dst=dst)
 
         if frontier:
             for frontier_node in frontier:
@@ -785,18 +814,6 @@ class RegionIdentifier:
 
         return list(graph.in_edges(region.head, data=data))
 
-    @staticmethod
-    def _region_out_edges(graph, region, data=False):
-
-        out_edges = []
-        for node in region.graph.nodes():
-            out_ = graph.out_edges(node, data=data)
-            for _, dst, data_ in out_:
-                if dst in region.graph:
-                    continue
-                out_edges.append((region, dst, data_))
-        return out_edges
-
     def _remove_node(self, graph: networkx.DiGraph, node):  # pylint:disable=no-self-use
         graph.remove_node(node)
 
@@ -837,9 +854,9 @@ class RegionIdentifier:
             self, graph: networkx.DiGraph, node_mommy, node_kiddie, force_multinode=False
     ):  # pylint:disable=no-self-use
 
-        in_edges_mommy = graph.in_edges(node_mommy, data=True)
-        out_edges_mommy = graph.out_edges(node_mommy, data=True)
-        out_edges_kiddie = graph.out_edges(node_kiddie, data=True)
+        in_edges_mommy = list(graph.in_edges(node_mommy, data=True))
+        out_edges_mommy = list(graph.out_edges(node_mommy, data=True))
+        out_edges_kiddie = list(graph.out_edges(node_kiddie, data=True))
 
         if not force_multinode and len(in_edges_mommy) <= 1 and len(out_edges_kiddie) <= 1:
             # it forms a region by itself :-)
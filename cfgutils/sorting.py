@@ -34,11 +34,7 @@ def find_merge_points(function_addr, function_endpoints, graph):  # pylint:disab
     :rtype: list
     """
 
-    merge_points = set()
-
-    for node in graph.nodes():
-        if graph.in_degree(node) > 1:
-            merge_points.add(node)
+    merge_points = {node for node, in_degree in graph.in_degree() if in_degree > 1}
 
     ordered_merge_points = quasi_topological_sort_nodes(graph, merge_points)
 
@@ -150,9 +146,9 @@ def quasi_topological_sort_nodes(
         graph_copy.add_edge(src, dst)
 
     # add loners
-    out_degree_zero_nodes = [node for (node, degree) in graph.out_degree() if degree == 0]
-    for node in out_degree_zero_nodes:
-        if graph.in_degree(node) == 0:
+    in_degrees = graph.in_degree
+    for node, out_degree in graph.out_degree():
+        if out_degree == 0 and in_degrees[node] == 0:
             graph_copy.add_node(node)
 
     # topological sort on acyclic graph `graph_copy`
@@ -1,6 +1,7 @@
 import sys
 import unittest
 from pathlib import Path
+from unittest import mock
 
 import networkx as nx
 
@@ -11,8 +12,12 @@ except ImportError:
     ANGR_AVAILABLE = False
 
 if ANGR_AVAILABLE:
-    from cfgutils.angr_utils.ail_graph_conv import binary_to_ail_cfgs
+    import ailment
+    from cfgutils.angr_utils import ail_graph_conv
+    from cfgutils.angr_utils.ail_graph_conv import binary_to_ail_cfgs, to_ail_supergraph
+    from cfgutils.angr_utils import block_matcher
     from cfgutils.angr_utils.block_matcher import AILBlockMatcher
+    from cfgutils.angr_utils.feat_extractor import AILBlockFeatureExtractor
     from angr.analyses.decompiler.utils import find_block_by_addr
 
 TEST_FILES = Path(__file__).parent / "data"
@@ -36,6 +41,51 @@ class TestAngrCFGTools(unittest.TestCase):
             original_nodes = attr.get("original_nodes", {})
             assert original_nodes
 
+    def test_compact_cfg(self):
+        cfg = binary_to_ail_cfgs(
+            TEST_FILES / "fmt_O0_noinline.o",
+            functions=["fmt"],
+            structuring_opts=False,
+            make_generic=True
+        )["fmt"]
+        csr_cfg = binary_to_ail_cfgs(
+            TEST_FILES / "fmt_O0_noinline.o",
+            functions=["fmt"],
+            structuring_opts=False,
+            make_generic=True,
+            compact=True,
+        )["fmt"]
+        assert csr_cfg.number_of_nodes() == cfg.number_of_nodes()
+        assert csr_cfg.number_of_edges() == cfg.number_of_edges()
+
+        edges = {(src.addr, src.idx, dst.addr, dst.idx) for src, dst in cfg.edges}
+        csr_edges = {
+            (src.addr, src.idx, csr_cfg.nodes[dst].addr, csr_cfg.nodes[dst].idx)
+            for i, src in enumerate(csr_cfg.nodes) for dst in csr_cfg.successors(i)
+        }
+        assert csr_edges == edges
+
+    def test_feat_extractor_reset(self):
+        cfgs, proj = binary_to_ail_cfgs(
+            TEST_FILES / "fmt_O0_noinline.o",
+            functions=["fmt"],
+            structuring_opts=False,
+            return_project=True
+        )
+        proj_cfg = proj.kb.cfgs.get_most_accurate()
+        features = ("arith_ins", "calls", "ins", "logic_ins", "branch_ins", "str_consts", "num_consts",
+                    "stack_addrs", "var_names", "call_names")
+
+        # a reused extractor must report the same features as a fresh one for every block
+        reused = AILBlockFeatureExtractor(proj, proj_cfg)
+        for node in cfgs["fmt"].nodes:
+            fresh = AILBlockFeatureExtractor(proj, proj_cfg)
+            fresh.walk(node)
+            reused.reset()
+            reused.walk(node)
+            for feature in features:
+                assert getattr(reused, feature) == getattr(fresh, feature)
+
     def test_block_matcher(self):
         cfgs0, p0 = binary_to_ail_cfgs(
             TEST_FILES / "fmt_O0_noinline.o",
@@ -63,6 +113,98 @@ class TestAngrCFGTools(unittest.TestCase):
         o2_blk = find_block_by_addr(main_o2, 0x40ce2b)
         assert mappings[o0_blk] == o2_blk
 
+    def test_block_matcher_in_pool(self):
+        cfgs0, p0 = binary_to_ail_cfgs(
+            TEST_FILES / "fmt_O0_noinline.o", functions=["main"], structuring_opts=False, return_project=True
+        )
+        cfgs2, p2 = binary_to_ail_cfgs(
+            TEST_FILES / "fmt_O2_noinline.o", functions=["main"], structuring_opts=False, return_project=True
+        )
+        main_o0, main_o2 = cfgs0["main"], cfgs2["main"]
+        # smaller graphs are never split over processes
+        assert len(main_o0) + len(main_o2) >= block_matcher._MIN_NODES_PER_WORKER * 2
+
+        sequential = AILBlockMatcher(main_o0, main_o2, proj1=p0, proj2=p2)
+        with mock.patch.object(
+            block_matcher, "_extract_features_in_pool", wraps=block_matcher._extract_features_in_pool
+        ) as in_pool:
+            pooled = AILBlockMatcher(main_o0, main_o2, proj1=p0, proj2=p2, max_workers=2)
+            assert in_pool.called
+
+        assert pooled.mapping == sequential.mapping
+        for attr in ("counts", "str_consts", "num_consts", "var_names", "stack_addrs", "func_names"):
+            for pooled_cache, sequential_cache in (
+                (pooled._g1_cache, sequential._g1_cache), (pooled._g2_cache, sequential._g2_cache)
+            ):
+                assert getattr(pooled_cache, attr).tolist() == getattr(sequential_cache, attr).tolist()
+
+    def test_decompile_in_pool(self):
+        functions = ["fmt", "main", "usage"]
+        sequential = binary_to_ail_cfgs(TEST_FILES / "fmt_O0_noinline.o", functions=functions, structuring_opts=False)
+        with mock.patch.object(
+            ail_graph_conv, "_decompile_functions_in_pool", wraps=ail_graph_conv._decompile_functions_in_pool
+        ) as in_pool:
+            pooled = binary_to_ail_cfgs(
+                TEST_FILES / "fmt_O0_noinline.o", functions=functions, structuring_opts=False, max_workers=2
+            )
+            assert in_pool.called
+
+        def _cfg_contents(cfg):
+            nodes = [(node.addr, tuple(str(stmt) for stmt in node.statements)) for node in cfg]
+            return nodes, [(src.addr, dst.addr) for src, dst in cfg.edges]
+
+        assert list(pooled) == list(sequential)
+        for name, cfg in sequential.items():
+            assert _cfg_contents(pooled[name]) == _cfg_contents(cfg)
+
+    def test_function_addrs(self):
+        by_name, proj = binary_to_ail_cfgs(
+            TEST_FILES / "fmt_O2_noinline.o", functions=["fmt"], structuring_opts=False, return_project=True
+        )
+        fmt_addr = proj.kb.functions["fmt"].addr
+        by_addr = binary_to_ail_cfgs(TEST_FILES / "fmt_O2_noinline.o", functions=[fmt_addr], structuring_opts=False)
+        targeted = binary_to_ail_cfgs(
+            TEST_FILES / "fmt_O2_noinline.o", functions=[fmt_addr], structuring_opts=False, targeted_cfg=True
+        )
+
+        def _block_stmts(cfg):
+            return sorted((node.addr, tuple(str(stmt) for stmt in node.statements)) for node in cfg)
+
+        # functions given by address decompile the same as by name, unless a targeted CFG is asked for
+        assert _block_stmts(by_addr["fmt"]) == _block_stmts(by_name["fmt"])
+        # a targeted CFG still finds the same blocks, only their statements may differ
+        assert sorted(node.addr for node in targeted["fmt"]) == sorted(node.addr for node in by_name["fmt"])
+
+    def test_project_cache(self):
+        binary_path = (TEST_FILES / "fmt_O0_noinline.o").resolve()
+        cache = ail_graph_conv._PROJECT_CACHE
+        ail_graph_conv.clear_project_cache()
+        # an entry for an older version of the binary, and more other binaries than the cache holds
+        cache[(str(binary_path), 0, None, False)] = (None, None)
+        for i in range(ail_graph_conv._PROJECT_CACHE_SIZE):
+            cache[(f"other_{i}", 0, None, False)] = (None, None)
+
+        proj, _ = ail_graph_conv._get_project_and_cfg(binary_path)
+        assert len(cache) == ail_graph_conv._PROJECT_CACHE_SIZE
+        assert (str(binary_path), 0, None, False) not in cache
+        assert ("other_0", 0, None, False) not in cache
+        assert ail_graph_conv._get_project_and_cfg(binary_path)[0] is proj
+        ail_graph_conv.clear_project_cache()
+
+    def test_supergraph_no_ret_calls(self):
+        b100, b200, b500 = (ailment.Block(addr, 4, statements=[]) for addr in (0x100, 0x200, 0x500))
+        graph = nx.DiGraph()
+        graph.add_edge(b200, b500, type="call")
+        graph.add_edge(b500, b100, type="call")
+        graph.add_edge(b200, b100, type="transition")
+
+        # removing the target of the first call drops the second call, and leaves 0x200 -> 0x100 to be merged
+        supergraph = to_ail_supergraph(graph)
+        assert [node.addr for node in supergraph] == [0x100]
+        assert supergraph.number_of_edges() == 0
+        merged_node = next(iter(supergraph))
+        assert supergraph.nodes[merged_node]["original_nodes"] == {b200, b100}
+
 
 if __name__ == "__main__":
     unittest.main(argv=sys.argv)
@@ -0,0 +1,82 @@
+import random
+import sys
+import unittest
+
+import networkx as nx
+
+from cfgutils.dominator import (
+    dfs_back_edges, dominates, DominatorTreeIntervals, dominance_frontiers_from_idom
+)
+
+
+def _random_cfg(rng, n_nodes):
+    # nodes start at 1, since dominates() stops walking up the tree at a falsy node
+    graph = nx.DiGraph()
+    graph.add_nodes_from(range(1, n_nodes + 1))
+    for node in range(2, n_nodes + 1):
+        graph.add_edge(rng.randint(1, node - 1), node)
+    for _ in range(n_nodes):
+        graph.add_edge(rng.randint(1, n_nodes), rng.randint(1, n_nodes))
+    return graph
+
+
+def _recursive_dfs_back_edges(graph, start_node):
+    visited = set()
+    finished = set()
+
+    def _dfs_back_edges_core(node):
+        visited.add(node)
+        for child in iter(graph[node]):
+            if child not in finished:
+                if child in visited:
+                    yield node, child
+                else:
+                    yield from _dfs_back_edges_core(child)
+        finished.add(node)
+
+    yield from _dfs_back_edges_core(start_node)
+
+
+class TestDominator(unittest.TestCase):
+    def test_dfs_back_edges_order(self):
+        graph = nx.DiGraph([(1, 2), (2, 3), (3, 2), (3, 4), (4, 1), (2, 5), (5, 5), (5, 4), (4, 2)])
+        back_edges = list(dfs_back_edges(graph, 1))
+        assert back_edges == [(3, 2), (4, 1), (4, 2), (5, 5)]
+        assert back_edges == list(_recursive_dfs_back_edges(graph, 1))
+
+        rng = random.Random(0)
+        for _ in range(50):
+            graph = _random_cfg(rng, rng.randint(2, 30))
+            assert list(dfs_back_edges(graph, 1)) == list(_recursive_dfs_back_edges(graph, 1))
+
+    def test_dfs_back_edges_deep_graph(self):
+        # much deeper than the recursion limit
+        n_nodes = 100000
+        graph = nx.DiGraph()
+        nx.add_path(graph, range(n_nodes))
+        graph.add_edge(n_nodes - 1, 0)
+        assert list(dfs_back_edges(graph, 0)) == [(n_nodes - 1, 0)]
+
+    def test_dominator_tree_intervals(self):
+        rng = random.Random(1)
+        for _ in range(30):
+            graph = _random_cfg(rng, rng.randint(2, 30))
+            # an unreachable node is outside of the tree
+            graph.add_edge(0x1000, 1)
+            idom = nx.immediate_dominators(graph, 1)
+            intervals = DominatorTreeIntervals(idom)
+            for dominator_node in graph:
+                for node in graph:
+                    assert intervals.dominates(dominator_node, node) == dominates(idom, dominator_node, node)
+
+    def test_dominance_frontiers_from_idom(self):
+        rng = random.Random(2)
+        for _ in range(30):
+            graph = _random_cfg(rng, rng.randint(2, 30))
+            graph.add_edge(0x1000, rng.randint(1, graph.number_of_nodes()))
+            idom = nx.immediate_dominators(graph, 1)
+            assert dominance_frontiers_from_idom(graph, 1, idom) == nx.dominance_frontiers(graph, 1)
+
+
+if __name__ == "__main__":
+    unittest.main(argv=sys.argv)
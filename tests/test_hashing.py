@@ -1,5 +1,8 @@
+import os
+import subprocess
 import sys
 import unittest
+from pathlib import Path
 
 import networkx as nx
 
@@ -91,6 +94,43 @@ class TestHashing(unittest.TestCase):
         #assert d13 <= d14
         #assert d14 <= d15
 
+    def test_floats_to_bits(self):
+        floats = [-1.0] * 128
+        for i in (0, 5, 63, 64, 127):
+            floats[i] = 0.5
+
+        bits = FunctionSimHasher.FloatsToBits(floats)
+        assert bits == [(1 << 0) | (1 << 5) | (1 << 63), (1 << 0) | (1 << 63), 0]
+
+    def test_hash_distance(self):
+        h1 = [0b1011, 1 << 63]
+        h2 = [0b0001, 0]
+        assert FunctionSimHasher.hash_distance(h1, h1) == 0
+        assert FunctionSimHasher.hash_distance(h1, h2) == 3
+
+    def test_block_hash_is_stable(self):
+        # blocks without an idx must hash the same in every run with the same PYTHONHASHSEED, since the order of the
+        # sets and graphs they are in depends on it
+        code = (
+            "from cfgutils.data import GenericBlock, GenericStatement\n"
+            "print(hash(GenericBlock(0x1, statements=[GenericStatement(0x2, 'assign', ['x', 0x13])])))\n"
+        )
+        env = dict(os.environ, PYTHONHASHSEED="0", PYTHONPATH=str(Path(__file__).parent.parent))
+        hashes = {
+            subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, check=True, text=True).stdout
+            for _ in range(3)
+        }
+        assert len(hashes) == 1
+
+    def test_unary_statement(self):
+        # unary ops are made with their only operand rather than a sequence of operands
+        not_5 = GenericStatement(0x1, "Not", 5)
+        assert not_5.operands == (5,)
+        assert not_5 == GenericStatement(0x2, "Not", [5])
+        assert GenericStatement(0x1, "Not", "rax").operands == ("rax",)
+        assert GenericStatement(0x1, "Not", 0).operands == (0,)
+        hash(GenericBlock(0x1, statements=[not_5]))
+
 
 if __name__ == "__main__":
     unittest.main(argv=sys.argv)
@@ -0,0 +1,90 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from cfgutils.os_utils import WorkDirContext, force_mkdir, timeout
+
+
+class TestOSUtils(unittest.TestCase):
+    def test_force_mkdir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "a" / "b"
+            force_mkdir(path)
+            (path / "stale").touch()
+            force_mkdir(path)
+            assert path.is_dir() and not any(path.iterdir())
+
+            # a directory that could not be removed is an error, rather than left as it was
+            (path / "stale").touch()
+            with mock.patch.object(shutil, "rmtree"):
+                with self.assertRaises(FileExistsError):
+                    force_mkdir(path)
+
+    def test_work_dir_context(self):
+        origin = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            outer = Path(tmp_dir).resolve() / "outer"
+            inner = outer / "inner"
+            inner.mkdir(parents=True)
+            context = WorkDirContext(inner)
+            try:
+                with WorkDirContext(outer):
+                    with context:
+                        assert Path.cwd() == inner
+                        # the same context entered again returns to where it was entered from each time
+                        os.chdir(outer)
+                        with context:
+                            assert Path.cwd() == inner
+                        assert Path.cwd() == outer
+                    assert Path.cwd() == outer
+                assert os.getcwd() == origin
+            finally:
+                os.chdir(origin)
+
+    @staticmethod
+    def _run_in_thread(func):
+        errors = []
+
+        def _target():
+            try:
+                func()
+            except BaseException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=_target)
+        thread.start()
+        thread.join()
+        return errors
+
+    @staticmethod
+    def _busy_loop(seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            pass
+
+    def test_timeout_in_thread(self):
+        def _timed_out():
+            with timeout(1):
+                self._busy_loop(5)
+
+        errors = self._run_in_thread(_timed_out)
+        assert len(errors) == 1 and isinstance(errors[0], TimeoutError)
+
+    def test_timeout_in_thread_finished(self):
+        def _finished():
+            with timeout(1):
+                pass
+            # the timer must not fire once the block is done
+            self._busy_loop(1.5)
+
+        assert self._run_in_thread(_finished) == []
+
+
+if __name__ == "__main__":
+    unittest.main(argv=sys.argv)